@@ -0,0 +1,318 @@
+import argparse
+import astropy.units as u
+from astropy.time import Time
+from collections import defaultdict
+import datetime
+import json
+import numpy as np
+import os
+import pandas as pd
+import platform
+import shutil
+import sqlite3
+import subprocess
+import time
+
+import sys
+sys.path.append("../src")
+
+from twobody import generate_ephemeris, MU
+from transforms import observer_heliocentric_states
+from observatory import OBSERVATORY_LOCATIONS
+from footprint import CameraFootprint
+
+NIGHT_ZERO = 60796
+
+BENCHMARKS = ["variant_orbit_ephemerides", "variant_orbit_ephemerides_twobody", "get_reachable_schedule",
+              "probability_from_id", "filter_observations", "create_digest2_input",
+              "create_findable_obs_tables"]
+
+
+def create_fixtures(path, n_nights=20, n_objects=12, visits_per_night=300, seed=42):
+    """Create a small synthetic survey that looks like the real inputs of the pipeline, without needing any
+    external data. This writes a fake camera footprint (`fov_map.npz`), schedule databases in the same form as
+    the opsim ones (`predicted_schedules/`) and filtered observation files with digest2 scores for a set of
+    near-Earth objects on circular-ish orbits close to the Earth (`synthetic_obs/`).
+
+    Parameters
+    ----------
+    path : `str`
+        Folder in which to put the fixtures
+    n_nights : `int`, optional
+        Number of nights in the survey, by default 20
+    n_objects : `int`, optional
+        Number of objects, by default 12
+    visits_per_night : `int`, optional
+        Number of visits in each night, by default 300
+    seed : `int`, optional
+        Random seed, by default 42
+    """
+    rng = np.random.default_rng(seed)
+    obs_path, schedule_path = os.path.join(path, "synthetic_obs"), os.path.join(path, "predicted_schedules")
+    for folder in [obs_path, schedule_path]:
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+        os.makedirs(folder)
+
+    # a circular camera footprint with a radius of 1.75 degrees
+    x = np.arange(-2, 2, 0.01)
+    np.savez(os.path.join(path, "fov_map.npz"), image=np.hypot(*np.meshgrid(x, x, indexing="ij")) < 1.75, x=x)
+    footprint = CameraFootprint(os.path.join(path, "fov_map.npz"))
+
+    # objects between 0.1 and 0.6 AU from the observatory at the start of the survey
+    location = OBSERVATORY_LOCATIONS["I11"]
+    epoch = NIGHT_ZERO + 1.0
+    observer = observer_heliocentric_states(Time([epoch], format="mjd"), location)[0]
+    orbits = np.zeros((n_objects, 6))
+    for i in range(n_objects):
+        direction = rng.normal(size=3) * [1, 1, 0.3]
+        orbits[i, :3] = observer[:3] + rng.uniform(0.1, 0.6) * direction / np.linalg.norm(direction)
+        tangent = np.cross([0, 0, 1], orbits[i, :3])
+        orbits[i, 3:] = tangent / np.linalg.norm(tangent) * np.sqrt(MU / np.linalg.norm(orbits[i, :3]))\
+            * rng.uniform(0.8, 1.2) + rng.normal(0, 0.003, 3)
+    hex_ids = np.array([f"{i:07x}" for i in range(n_objects)])
+
+    schedules, observations = [], []
+    for night in range(n_nights):
+        times = NIGHT_ZERO + night + 1.0 + np.arange(visits_per_night) * 0.0012
+        eph = generate_ephemeris(orbits, np.full(n_objects, epoch), times,
+                                 observer_heliocentric_states(Time(times, format="mjd"), location),
+                                 H=np.full(n_objects, 22.0))
+
+        # random pointings, except that most objects get a tracklet of three visits each night
+        field_ra = rng.uniform(0, 360, len(times))
+        field_dec = np.degrees(np.arcsin(rng.uniform(-1, 0.3, len(times))))
+        for i in range(n_objects):
+            if rng.random() < 0.7:
+                first = rng.integers(0, len(times) - 50)
+                for k in (first, first + 25, first + 50):
+                    row = eph[(eph["orbit_id"] == i) & (eph["time_index"] == k)].iloc[0]
+                    field_ra[k] = row["RA_deg"] + rng.normal(0, 0.5)
+                    field_dec[k] = row["Dec_deg"] + rng.normal(0, 0.5)
+        schedule = pd.DataFrame({"fieldRA": field_ra, "fieldDec": field_dec, "observationStartMJD": times,
+                                 "filter": rng.choice(list("ugrizy"), len(times)),
+                                 "fiveSigmaDepth": rng.normal(23.5, 0.3, len(times)),
+                                 "rotSkyPos": rng.uniform(0, 360, len(times)), "night": night + 1})
+        schedules.append(schedule)
+
+        # an object is observed if it is in the footprint of a visit and bright enough
+        rotations = footprint.visit_rotations(field_ra, field_dec, schedule["rotSkyPos"].values)
+        visit = eph["time_index"].values
+        seen = footprint.in_footprint(eph["RA_deg"].values, eph["Dec_deg"].values, visit, rotations)\
+            & (eph["VMag"].values < schedule["fiveSigmaDepth"].values[visit] + 1)
+        seen_eph = eph[seen]
+        observations.append(pd.DataFrame({"hex_id": hex_ids[seen_eph["orbit_id"].values],
+                                          "ObjID": [f"S{i:06d}" for i in seen_eph["orbit_id"]],
+                                          "AstRA(deg)": seen_eph["RA_deg"].values,
+                                          "AstDec(deg)": seen_eph["Dec_deg"].values,
+                                          "FieldMJD_TAI": seen_eph["mjd_utc"].values,
+                                          "observedTrailedSourceMag": seen_eph["VMag"].values,
+                                          "optFilter": schedule["filter"].values[visit[seen]],
+                                          "night": night,
+                                          "ang_vel": np.hypot(seen_eph["vRAcosDec"],
+                                                              seen_eph["vDec"]).values}))
+
+    # every schedule database has the whole survey in it (so any night can be predicted)
+    schedules = pd.concat(schedules)
+    for name in ["baseline_v3.3_1yrs.db"] + [f"night{night + 1}_15days.db" for night in range(n_nights)]:
+        con = sqlite3.connect(os.path.join(schedule_path, name))
+        schedules.to_sql("observations", con, index=False)
+        con.close()
+
+    obs = pd.concat(observations)
+    obs["n_obs"] = obs.groupby(["hex_id", "night"])["night"].transform("count")
+    obs["scores"] = rng.uniform(50, 100, n_objects)[obs["ObjID"].str[1:].astype(int)]
+    obs.index = obs["hex_id"].values
+    for night in range(n_nights):
+        file_path = os.path.join(obs_path, f"filtered_night_{night:04d}_with_scores.h5")
+        obs[obs["night"] == night].to_hdf(file_path, key="df")
+
+    # nothing is found before the survey starts
+    pd.Series(np.full(n_objects, 10000), index=hex_ids).to_hdf(os.path.join(obs_path,
+                                                                            "findable_obs_year_1.h5"),
+                                                               key="df")
+
+    with open(os.path.join(path, "fixtures.json"), "w") as f:
+        json.dump({"n_nights": n_nights, "n_objects": n_objects, "visits_per_night": visits_per_night,
+                   "seed": seed, "n_observations": len(obs)}, f)
+
+
+def time_call(func, repeats=3, setup=None):
+    """Time a function several times (running `setup` before each call without timing it)"""
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {"times": times, "min": min(times), "median": float(np.median(times))}
+
+
+def run_benchmarks(path, benchmarks=BENCHMARKS, repeats=3, night=0):
+    """Time each of the hot paths of the pipeline on the synthetic fixtures (see `create_fixtures`)
+
+    Parameters
+    ----------
+    path : `str`
+        Folder containing the fixtures
+    benchmarks : `list`, optional
+        Which benchmarks to run, by default all of `BENCHMARKS`
+    repeats : `int`, optional
+        How many times to time each one, by default 3
+    night : `int`, optional
+        Night of the fixtures to use, by default 0
+
+    Returns
+    -------
+    results : `dict`
+        Times of each benchmark (or the reason it was skipped if its dependencies are missing)
+    """
+    for benchmark in benchmarks:
+        if benchmark not in BENCHMARKS:
+            raise ValueError(f"Invalid value for `benchmarks`: {benchmark}")
+
+    obs_path = os.path.join(path, "synthetic_obs")
+    fov_map_path = os.path.join(path, "fov_map.npz")
+    out_path = os.path.join(path, "benchmark_output")
+    os.makedirs(out_path, exist_ok=True)
+
+    obs = pd.read_hdf(os.path.join(obs_path, f"filtered_night_{night:04d}_with_scores.h5"))
+    sorted_obs = obs[obs["n_obs"] >= 3].sort_values(["hex_id", "FieldMJD_TAI"])
+    sorted_obs.index.name = "hex_id"
+    hex_id = sorted_obs.index[0]
+    rows = sorted_obs.loc[hex_id]
+
+    def mitigation_inputs():
+        from mitigation import prepare_schedule, get_reachable_schedule
+        full_schedule, night_list, night_lengths, first_visit_times = prepare_schedule(
+            night, schedule_path=os.path.join(path, "predicted_schedules"))
+        reachable_schedule = get_reachable_schedule(rows, first_visit_times, night_list, night_lengths,
+                                                    full_schedule)
+        return full_schedule, night_list, night_lengths, first_visit_times, reachable_schedule
+
+    def variant_orbits(backend):
+        from variant_orbits import variant_orbit_ephemerides
+        reachable_schedule = mitigation_inputs()[-1]
+        return lambda: variant_orbit_ephemerides(
+            ra=rows.iloc[0]["AstRA(deg)"] * u.deg, dec=rows.iloc[0]["AstDec(deg)"] * u.deg,
+            ra_end=rows.iloc[-1]["AstRA(deg)"] * u.deg, dec_end=rows.iloc[-1]["AstDec(deg)"] * u.deg,
+            delta_t=(rows.iloc[-1]["FieldMJD_TAI"] - rows.iloc[0]["FieldMJD_TAI"]) * u.day,
+            obstime=Time(rows.iloc[0]["FieldMJD_TAI"], format="mjd"),
+            distances=np.logspace(-1, 1, 51) * u.AU, radial_velocities=np.linspace(-50, 10, 21) * u.km / u.s,
+            eph_times=Time(reachable_schedule["observationStartMJD"].values, format="mjd"), only_neos=True,
+            ephemeris_backend=backend, num_jobs=1)
+
+    def reachable():
+        from mitigation import get_reachable_schedule
+        full_schedule, night_list, night_lengths, first_visit_times, _ = mitigation_inputs()
+        return lambda: get_reachable_schedule(rows, first_visit_times, night_list, night_lengths,
+                                              full_schedule)
+
+    def probability():
+        from mitigation import probability_from_id
+        full_schedule, night_list, night_lengths, first_visit_times, _ = mitigation_inputs()
+        return lambda: probability_from_id(hex_id, sorted_obs, distances=np.logspace(-1, 1, 51) * u.AU,
+                                           radial_velocities=np.linspace(-50, 10, 21) * u.km / u.s,
+                                           prior_obs_nights=defaultdict(list),
+                                           first_visit_times=first_visit_times,
+                                           full_schedule=full_schedule, night_lengths=night_lengths,
+                                           night_list=night_list, fov_map_path=fov_map_path, seed=42)
+
+    def filter_observations():
+        from trackletfilter import filter_observations
+        raw = obs.reset_index(drop=True)[["ObjID", "night", "AstRA(deg)", "AstDec(deg)", "FieldMJD_TAI"]]
+        return lambda: filter_observations(raw.copy(), min_obs=3, min_arc=1, max_time=90)
+
+    def digest2_input():
+        from digest2 import create_digest2_input
+        return lambda: create_digest2_input(file_name=f"filtered_night_{night:04d}_with_scores.h5",
+                                            in_path=obs_path, out_path=out_path)
+
+    def remove_digest2_output():
+        output = os.path.join(out_path, f"filtered_night_{night:04d}_with_scores.obs")
+        if os.path.exists(output):
+            os.remove(output)
+
+    def findable_tables():
+        from findable_tables import create_findable_obs_tables
+        n_nights = len([f for f in os.listdir(obs_path) if f.startswith("filtered_night")])
+        return lambda: create_findable_obs_tables(nights=range(n_nights), in_path=obs_path,
+                                                  out_path=os.path.join(out_path, "findable_obs.h5"))
+
+    # each entry creates the function to time (doing any setup that shouldn't be timed)
+    setups = {"variant_orbit_ephemerides": (lambda: variant_orbits("pyoorb"), None),
+              "variant_orbit_ephemerides_twobody": (lambda: variant_orbits("twobody"), None),
+              "get_reachable_schedule": (reachable, None),
+              "probability_from_id": (probability, None),
+              "filter_observations": (filter_observations, None),
+              "create_digest2_input": (digest2_input, remove_digest2_output),
+              "create_findable_obs_tables": (findable_tables, None)}
+
+    results = {}
+    for benchmark in benchmarks:
+        make, setup = setups[benchmark]
+        try:
+            func = make()
+        except ImportError as e:
+            print(f"Skipping {benchmark}: {e}")
+            results[benchmark] = {"skipped": str(e)}
+            continue
+        results[benchmark] = time_call(func, repeats=repeats, setup=setup)
+        print(f"{benchmark}: {results[benchmark]['min']:1.3f}s (best of {repeats})")
+    return results
+
+
+def compare_results(results, previous):
+    """Print the ratio of each benchmark's best time to that of a previous run"""
+    for benchmark, result in results["benchmarks"].items():
+        before = previous["benchmarks"].get(benchmark, {})
+        if "min" in result and "min" in before:
+            print(f"{benchmark}: {before['min']:1.3f}s -> {result['min']:1.3f}s "
+                  f"({result['min'] / before['min']:1.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on synthetic fixtures')
+    parser.add_argument('-f', '--fixture-path', default="../output/benchmark_fixtures", type=str,
+                        help='Folder for the synthetic fixtures (created if they do not exist)')
+    parser.add_argument('-o', '--out-file', default="../output/benchmarks.json", type=str,
+                        help='JSON file in which to save the results')
+    parser.add_argument('-b', '--benchmarks', default=BENCHMARKS, nargs="+", choices=BENCHMARKS,
+                        help='Which benchmarks to run')
+    parser.add_argument('-r', '--repeats', default=3, type=int,
+                        help='How many times to time each benchmark')
+    parser.add_argument('-c', '--compare', default=None, type=str,
+                        help='JSON file of a previous run to compare to')
+    parser.add_argument('-R', '--regenerate', action="store_true",
+                        help='Create the fixtures even if they already exist')
+    args = parser.parse_args()
+
+    if args.regenerate or not os.path.exists(os.path.join(args.fixture_path, "fixtures.json")):
+        print("Creating fixtures...")
+        create_fixtures(args.fixture_path)
+
+    with open(os.path.join(args.fixture_path, "fixtures.json")) as f:
+        fixtures = json.load(f)
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+
+    results = {"commit": commit, "date": datetime.datetime.now().isoformat(),
+               "python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+               "fixtures": fixtures,
+               "benchmarks": run_benchmarks(args.fixture_path, benchmarks=args.benchmarks,
+                                            repeats=args.repeats)}
+
+    with open(args.out_file, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare_results(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+import argparse
+import glob
+import os
+import time
+
+import sys
+sys.path.append("../src")
+
+from scheduling import build_schedule_store
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Convert schedule databases into columnar stores (one-time)')
+    parser.add_argument('-s', '--schedule-path',
+                        default="/epyc/projects/neocp-predictions/output/predicted_schedules/",
+                        type=str, help='Path to the folder containing the schedule databases')
+    parser.add_argument('-R', '--rebuild', action="store_true",
+                        help="Whether to rebuild stores that already exist")
+    args = parser.parse_args()
+
+    for db_path in sorted(glob.glob(os.path.join(args.schedule_path, "*.db"))):
+        store_path = os.path.splitext(db_path)[0]
+        if os.path.exists(os.path.join(store_path, "night_offsets.npy")) and not args.rebuild:
+            continue
+        start = time.time()
+        build_schedule_store(db_path, store_path)
+        print(f"Converted {db_path} in {time.time() - start:1.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,14 @@ import pandas as pd
 import difi
 import time
 import os
+import sys
+sys.path.append("../src")
+
+from findability import findable_windows
+
 
 def create_findable_obs_tables(min_nights=3, detection_window=15, nights=range(366),
+                               in_path="../output/synthetic_obs/",
                                out_path="../output/findable_obs_year_1.h5"):
     print("Let the games begin...")
     start = time.time()
@@ -12,9 +18,10 @@ def create_findable_obs_tables(min_nights=3, detection_window=15, nights=range(3
     # get all of the observations
     obs_dfs = [None for _ in nights]
     for i, night in enumerate(nights):
-        file_path = f"../output/synthetic_obs/filtered_night_{night:04d}_with_scores.h5"
+        file_path = os.path.join(in_path, f"filtered_night_{night:04d}_with_scores.h5")
         if os.path.exists(file_path):
-            obs_dfs[i] = pd.read_hdf(file_path)[["FieldMJD_TAI", "night", "hex_id"]].sort_values("FieldMJD_TAI")
+            obs_dfs[i] = pd.read_hdf(file_path)[["FieldMJD_TAI", "night", "hex_id"]]\
+                .sort_values("FieldMJD_TAI")
 
     obs_dfs = [df for df in obs_dfs if df is not None]
     all_obs = pd.concat(obs_dfs)
@@ -36,22 +43,17 @@ def create_findable_obs_tables(min_nights=3, detection_window=15, nights=range(3
     difi_done = time.time()
 
     # hack around difi to check if the window is actually satisfied and on which night it is first detected
-    findable_obs["night_detected"] = np.zeros(len(findable_obs)).astype(int)
-    findable_obs["actually_findable"] = np.repeat(True, len(findable_obs))
-
-    for ind, row in findable_obs.iterrows():
-        obs_nights = np.unique(all_obs.loc[row["obs_ids"]]["night"].values)
-        diff_nights = np.diff(obs_nights)
-        window_sizes = np.array([sum(diff_nights[i:i + min_nights - 1])
-                                for i in range(len(diff_nights) - min_nights + 2)])
-
-        # record whether any are short enough
-        if np.any(window_sizes <= detection_window):
-            detection_obs_ind = np.arange(len(window_sizes))[window_sizes <= detection_window][0] + min_nights - 1
-            findable_obs.loc[ind, "night_detected"] = obs_nights[detection_obs_ind]
-        else:
-            findable_obs.loc[ind, "night_detected"] = -1
-            findable_obs.loc[ind, "actually_findable"] = False
+    # (if there are no candidate objects then there is nothing to check and an empty table is saved)
+    night_detected, actually_findable = np.repeat(-1, len(findable_obs)), np.repeat(False, len(findable_obs))
+    if len(findable_obs) > 0:
+        obs_ids = findable_obs["obs_ids"].values
+        group_ids = np.repeat(np.arange(len(findable_obs)), [len(ids) for ids in obs_ids])
+        obs_nights = all_obs.loc[np.concatenate(obs_ids)]["night"].values
+        groups, findable, first_night = findable_windows(group_ids, obs_nights, min_nights=min_nights,
+                                                         detection_window=detection_window)
+        night_detected[groups], actually_findable[groups] = first_night, findable
+    findable_obs["night_detected"] = night_detected
+    findable_obs["actually_findable"] = actually_findable
 
     findable_obs = findable_obs[findable_obs["actually_findable"]].set_index("hex_id")["night_detected"]
     findable_obs.to_hdf(out_path, key="df")
@@ -63,4 +65,4 @@ def create_findable_obs_tables(min_nights=3, detection_window=15, nights=range(3
 
 
 if __name__ == "__main__":
-    create_findable_obs_tables()
\ No newline at end of file
+    create_findable_obs_tables()
@@ -1,7 +1,6 @@
 import argparse
 import astropy.units as u
 from astropy.time import Time
-from astropy.coordinates import SkyCoord
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
@@ -9,11 +8,13 @@ from matplotlib.colors import BoundaryNorm
 from matplotlib.collections import PatchCollection
 import time
 
-from rubin_sim.utils import LsstCameraFootprint
 import os.path
+import gc
+import hashlib
 
-from multiprocessing import Pool
+from multiprocessing import Pool, resource_tracker
 from functools import partial
+from contextlib import nullcontext
 
 from collections import defaultdict
 
@@ -24,20 +25,23 @@ backend = PYOORB()
 import sys
 sys.path.append("../src")
 
-from variant_orbits import variant_orbit_ephemerides
+from variant_orbits import (variant_orbit_ephemerides, variant_orbit_ephemerides_chunks, adaptive_grid_sample,
+                            sequential_grid_sample)
+from observatory import ObservatoryEphemeris
+from footprint import load_footprint
+from findability import findable_windows
+from trackletfilter import filter_tracklet_groups
+from fieldindex import FieldIndex, move_along_sky
+from shared_tables import share_dataframe, attach_dataframe, share_object, attach_object, release_shared
+from checkpoint import read_checkpoint, start_checkpoint, append_checkpoint
+from instrumentation import StageTimer, save_timings
 from scheduling import get_LSST_schedule
 from magnitudes import convert_colour_mags
 
 NIGHT_ZERO = 60796
 
-
-def filter_tracklets(df, min_obs=2, min_arc=1, max_time=90):
-    init = SkyCoord(ra=df["RA_deg"].iloc[0], dec=df["Dec_deg"].iloc[0], unit="deg")
-    final = SkyCoord(ra=df["RA_deg"].iloc[-1], dec=df["Dec_deg"].iloc[-1], unit="deg")
-
-    return np.logical_and.reduce((len(df) >= min_obs,
-                                  init.separation(final).to(u.arcsecond).value > min_arc,
-                                  df["mjd_utc"].diff().min() * 1440 < max_time))
+# tables and settings shared with each pool worker (set by `_attach_shared` and `_attach_setup`)
+_WORKER_TABLES = {}
 
 
 def get_detection_probabilities(night_start, detection_window=15, min_nights=3,
@@ -45,7 +49,9 @@ def get_detection_probabilities(night_start, detection_window=15, min_nights=3,
                                 in_path="/epyc/projects/neocp-predictions/output/synthetic_obs/",
                                 out_path="/epyc/projects/neocp-predictions/output/mitigation_results/",
                                 fov_map_path="/epyc/ssd/users/tomwagg/rubin_sim_data/maf/fov_map.npz",
-                                save_results=True):
+                                observatory_path=None, sampling="grid", orbits_per_chunk=None, seed=None,
+                                save_results=True, checkpoint=True, min_score=65, criteria=None, pool=None,
+                                obs_cache=None, detection_nights=None):
     """Get the probability that LSST will detect each object that was observed in a particular night
 
     Parameters
@@ -58,73 +64,107 @@ def get_detection_probabilities(night_start, detection_window=15, min_nights=3,
         Minimum number of nights on which observations need to have occurred, by default 3
     pool_size : `int`, optional
         How many workers to put in the multiprocessing pool, by default 48
+    observatory_path : `str`, optional
+        Folder containing a precomputed observatory table (see `observatory.build_observatory_table`) to use
+        for observer positions instead of computing them for each object, by default None
+    sampling : `str`, optional
+        How to sample the grid of distances and radial velocities, either "grid", "adaptive" or "sequential"
+        (see `probability_from_id`), by default "grid". For the latter two the number of orbits used and the
+        error/interval on each probability are saved alongside the probabilities.
+    orbits_per_chunk : `int`, optional
+        Number of variant orbits to generate ephemerides for at once in each worker, which bounds the memory
+        use (see `probability_from_id`), by default None (all at once)
+    seed : `int`, optional
+        Seed from which the random stream of each object is derived (see `object_seed`), which makes the
+        results reproducible regardless of the pool, by default None (unseeded)
     save_results : `bool`, optional
-        Whether to save the results to a file, by default True
+        Whether to save the results to a file, by default True. The time spent (and number of items
+        processed) in each stage of the calculation, for the night as a whole and for each object, is also
+        saved in `night{night_start}_timings.json`
+    checkpoint : `bool`, optional
+        Whether to append the result of each object to `night{night_start}_checkpoint.jsonl` as soon as it
+        finishes (only if `save_results`). Objects already in the file are not run again, so a job that was
+        stopped part way through picks up where it left off. The file starts with the settings of the run and
+        is started again if they don't match. It is removed once the final results are saved. By default True
+    min_score : `float`, optional
+        Minimum digest2 score for an object to be considered, by default 65
+    criteria : `list` of `dict`, optional
+        Run a parameter sweep instead of a single set of criteria. Each dict may set "detection_window",
+        "min_nights" and "min_score" (anything missing takes the value given to this function). The
+        ephemerides of each object are only computed once (for the longest window) and every set of criteria
+        is evaluated against the same detections, giving one probability per set (NaN if the object's score
+        is below its "min_score"). Only works with "grid" sampling. The results are saved in
+        `night{night_start}_sweep.h5` (with the criteria under the "criteria" key). By default None
+    pool : `multiprocessing Pool`, optional
+        An existing pool to use instead of starting one (with `pool_size` workers), by default None
+    obs_cache : `dict`, optional
+        Observation tables that have already been read in, keyed by night. Nights that are needed are added
+        and those that are not are removed, so passing the same dict for consecutive nights only reads the
+        new night each time, by default None (read everything)
+    detection_nights : `pandas Series`, optional
+        The night on which each object is first findable (`findable_obs_year_1.h5`) if it has already been
+        read in, by default None
 
     Returns
     -------
     probs : `list`
-        Estimated probability that each object will be detected by LSST alone
+        Estimated probability that each object will be detected by LSST alone (or an array with a column for
+        each set of `criteria`)
     unique_objs : `list`
         List of unique hex ids that have digest2 > 65 that were observed on `night_start`
     """
     lap = time.time()
+    night_timer = StageTimer()
+
+    # for a sweep, load everything needed by the loosest criteria and narrow it down for each set later
+    if criteria is not None:
+        if sampling != "grid":
+            raise ValueError(f"Invalid value for `sampling`: {sampling} (a sweep requires 'grid')")
+        criteria = [{"detection_window": detection_window, "min_nights": min_nights, "min_score": min_score,
+                     **c} for c in criteria]
+        detection_window = max(c["detection_window"] for c in criteria)
+        min_score = min(c["min_score"] for c in criteria)
 
     if not os.path.exists(os.path.join(in_path, f"filtered_night_{night_start:04d}_with_scores.h5")):
         print(f"Night {night_start} does not exist")
         return None, None
 
-    # create a list of nights in the detection window and get schedule for them
-    night_list = list(range(night_start, night_start + detection_window))
-
-    if schedule_type == "predicted":
-        full_schedule = get_LSST_schedule(night=night_start, schedule_type=schedule_type,
-                                          night_zero=NIGHT_ZERO,
-                                          schedule_path=in_path.replace("synthetic_obs", "predicted_schedules"))
-    else:
-        full_schedule = get_LSST_schedule(night=(night_start, night_start + detection_window - 1),
-                                          schedule_type=schedule_type, night_zero=NIGHT_ZERO,
-                                          schedule_path=in_path.replace("synthetic_obs", "predicted_schedules"))
-
-    # offset the schedule by one row and re-merge to get the previous night column
-    shifted = full_schedule.shift()
-    full_schedule["previousNight"] = shifted["night"]
-
-    # calculate the length of each night in days
-    night_lengths = np.zeros(detection_window)
-    for i, night in enumerate(night_list):
-        mask = full_schedule["night"] == night
-
-        # ignore nights that have no observations (bad weather/downtime)
-        if not full_schedule[mask].empty:
-            night_lengths[i] = full_schedule[mask].iloc[-1]["observationStartMJD"]\
-                - full_schedule[mask].iloc[0]["observationStartMJD"]
-
-    # get the first/last visit from each night
-    night_transition = full_schedule["night"] != full_schedule["previousNight"]
-    first_visit_times = full_schedule[night_transition]["observationStartMJD"].values.astype(float)
+    full_schedule, night_list, night_lengths, first_visit_times = prepare_schedule(
+        night_start, detection_window=detection_window, schedule_type=schedule_type,
+        schedule_path=in_path.replace("synthetic_obs", "predicted_schedules"))
 
+    night_timer.add("schedule", time.time() - lap, len(full_schedule))
     print(f"[{time.time() - lap:1.1f}s] Schedule is loaded in and ready!")
     lap = time.time()
 
-    obs_dfs = [pd.read_hdf(os.path.join(in_path, f"filtered_night_{i:04d}_with_scores.h5")).sort_values("FieldMJD_TAI")
-                for i in range(max(night_start - detection_window + 1, 0), night_list[-1])
-                if os.path.exists(os.path.join(in_path, f"filtered_night_{i:04d}_with_scores.h5"))]
-    all_obs = pd.concat(obs_dfs)
+    obs_nights = [i for i in range(max(night_start - detection_window + 1, 0), night_list[-1])
+                  if os.path.exists(os.path.join(in_path, f"filtered_night_{i:04d}_with_scores.h5"))]
 
+    # drop any cached nights that have left the window and only read the ones we don't already have
+    obs_cache = {} if obs_cache is None else obs_cache
+    for i in set(obs_cache) - set(obs_nights):
+        del obs_cache[i]
+    for i in obs_nights:
+        if i not in obs_cache:
+            obs_cache[i] = pd.read_hdf(os.path.join(in_path, f"filtered_night_{i:04d}_with_scores.h5"))\
+                .sort_values("FieldMJD_TAI")
+    all_obs = pd.concat([obs_cache[i] for i in obs_nights])
+
+    night_timer.add("observations", time.time() - lap, len(all_obs))
     print(f"[{time.time() - lap:1.1f}s] Observation files read in")
     lap = time.time()
 
-    # get the sorted observations for the start night (that have digest2 > 65, >= 3 obs)
+    # get the sorted observations for the start night (that have digest2 > `min_score`, >= 3 obs)
     sorted_obs = all_obs[(all_obs["night"] == night_start)
-                         & (all_obs["scores"] >= 65)
+                         & (all_obs["scores"] >= min_score)
                          & (all_obs["n_obs"] >= 3)
                          & (all_obs["ang_vel"] < 1.5)].sort_values(["ObjID", "FieldMJD_TAI"])
     unique_objs = sorted_obs['hex_id'].unique()
 
     # work out which objects would have already been found before tonight and remove them
     # note: the reduced_nights decreases the array size before the `isin` call
-    detection_nights = pd.read_hdf(os.path.join(in_path, f"findable_obs_year_1.h5"))
+    if detection_nights is None:
+        detection_nights = pd.read_hdf(os.path.join(in_path, "findable_obs_year_1.h5"))
     reduced_nights = detection_nights.loc[list(set(detection_nights.index).intersection(set(unique_objs)))]
     already_found_ids = reduced_nights[reduced_nights < night_start].index
     sorted_obs = sorted_obs[~np.isin(sorted_obs["hex_id"], already_found_ids)]
@@ -134,6 +174,7 @@ def get_detection_probabilities(night_start, detection_window=15, min_nights=3,
     all_obs = all_obs[(all_obs["night"] > night_start - detection_window) & (all_obs["night"] < night_start)]
     prior_obs = all_obs[all_obs.index.isin(unique_objs)]
 
+    night_timer.add("masks", time.time() - lap, len(unique_objs))
     print(f"[{time.time() - lap:1.1f}s] Masks applied to observation files")
     lap = time.time()
 
@@ -145,35 +186,313 @@ def get_detection_probabilities(night_start, detection_window=15, min_nights=3,
         s = prior_obs.groupby("hex_id").apply(lambda x: list(x["night"].unique()))
         prior_obs_nights = s.to_dict(into=dd)
 
+    night_timer.add("prior_nights", time.time() - lap, len(prior_obs))
     print(f"[{time.time() - lap:1.1f}s] Everything is prepped and ready for probability calculations")
     lap = time.time()
 
+    # the table is memory-mapped so workers only receive the path and map it themselves
+    observatory = ObservatoryEphemeris(observatory_path) if observatory_path is not None else None
+
     print(f"Starting pool for {len(unique_objs)} objects with {pool_size} workers...")
     sorted_obs.set_index("hex_id", inplace=True)
 
-    # calculate detection probabilities
-    with Pool(pool_size) as pool:
-        probs = pool.map(partial(probability_from_id, sorted_obs=sorted_obs,
-                                 distances=np.logspace(-1, 1, 51) * u.AU,
-                                 radial_velocities=np.linspace(-50, 10, 21) * u.km / u.s,
-                                 prior_obs_nights=prior_obs_nights,
-                                 first_visit_times=first_visit_times, full_schedule=full_schedule,
-                                 night_lengths=night_lengths, night_list=night_list,
-                                 detection_window=detection_window, min_nights=min_nights,
-                                 fov_map_path=fov_map_path), unique_objs)
-
-    print(f"Finished with the pool! [{time.time() - lap:1.1f}s]")
+    # use a positional index so that reachable visits can be passed around as row numbers
+    full_schedule.reset_index(drop=True, inplace=True)
+
+    # put the big tables in shared memory so each worker attaches once per night
+    shared_obs, obs_blocks = share_dataframe(sorted_obs)
+    shared_schedule, schedule_blocks = share_dataframe(full_schedule)
+
+    # the grid of distances and radial velocities of the variant orbits
+    distances = np.logspace(-1, 1, 51) * u.AU
+    radial_velocities = np.linspace(-50, 10, 21) * u.km / u.s
+
+    # pick up any results from a previous run of this night that was stopped part way through (as long as it
+    # used the same settings, otherwise start again)
+    probs = [None for _ in unique_objs]
+    checkpoint_path = os.path.join(out_path, f"night{night_start}_checkpoint.jsonl")
+    use_checkpoint = save_results and checkpoint
+    if use_checkpoint:
+        config = dict(night_start=night_start, detection_window=detection_window, min_nights=min_nights,
+                      schedule_type=schedule_type, sampling=sampling, seed=seed, min_score=min_score,
+                      criteria=criteria, orbits_per_chunk=orbits_per_chunk,
+                      observatory_path=observatory_path, fov_map_path=fov_map_path,
+                      distances=distances.to(u.AU).value,
+                      radial_velocities=radial_velocities.to(u.km / u.s).value)
+        done = read_checkpoint(checkpoint_path, config=config)
+        if len(done) == 0:
+            start_checkpoint(checkpoint_path, config)
+        for i, hex_id in enumerate(unique_objs):
+            if hex_id in done:
+                probs[i] = done[hex_id]["prob"] if sampling == "grid"\
+                    else (done[hex_id]["prob"], done[hex_id]["details"])
+        if len(done) > 0:
+            print(f"Resuming from checkpoint, {sum(p is not None for p in probs)} objects already done")
+    todo = np.array([i for i, p in enumerate(probs) if p is None], dtype=int)
+
+    # the handles of the tables (which include every unique ID) and the settings are shared once per night as
+    # well, so each task only carries the name of this block along with its own object
+    setup_name, setup_block = share_object({
+        "shared": (shared_obs, shared_schedule),
+        "reachable": dict(first_visit_times=first_visit_times, night_list=night_list,
+                          night_lengths=night_lengths, observatory=observatory),
+        "probability": dict(first_visit_times=first_visit_times, distances=distances,
+                            radial_velocities=radial_velocities, night_lengths=night_lengths,
+                            night_list=night_list, detection_window=detection_window, min_nights=min_nights,
+                            fov_map_path=fov_map_path, observatory=observatory, sampling=sampling,
+                            orbits_per_chunk=orbits_per_chunk, seed=seed, criteria=criteria)})
+
+    # calculate detection probabilities (using the given pool if there is one)
+    try:
+        with (Pool(pool_size) if pool is None else nullcontext(pool)) as pool, \
+                (open(checkpoint_path, "a") if use_checkpoint else nullcontext()) as checkpoint_file:
+            # estimate the cost of each object from the size of its reachable schedule (which is cheap to get)
+            reachable = pool.map(partial(_reachable_from_shared, setup_name=setup_name), unique_objs[todo])
+            reachable_visits = [visits for visits, _ in reachable]
+            costs = np.array([len(visits) for visits in reachable_visits])
+            order = np.argsort(-costs, kind="stable")
+
+            # start the record of each object with the time it took to find its reachable schedule
+            object_timings = {}
+            for j, (visits, stages) in enumerate(reachable):
+                object_timings[unique_objs[todo[j]]] = stages
+
+            night_timer.add("reachable_pass", time.time() - lap, len(todo))
+            print(f"[{time.time() - lap:1.1f}s] Reachable schedules found, "
+                  f"{(costs == 0).sum()} objects have none")
+            lap = time.time()
+
+            # dispatch the most expensive objects first in small chunks so that no worker is left with a long
+            # tail at the end, results come back in any order so put them back in place
+            busy_time = defaultdict(float)
+            tasks = ((todo[j], unique_objs[todo[j]], reachable_visits[j],
+                      prior_obs_nights[unique_objs[todo[j]]]) for j in order)
+            for i, prob, worker, elapsed, stages in pool.imap_unordered(
+                    partial(_probability_from_shared, setup_name=setup_name), tasks):
+                probs[i] = prob
+                busy_time[worker] += elapsed
+                object_timings[unique_objs[i]] = {**object_timings[unique_objs[i]], **stages}
+                if use_checkpoint:
+                    record = {"hex_id": unique_objs[i], "prob": prob} if sampling == "grid"\
+                        else {"hex_id": unique_objs[i], "prob": prob[0], "details": prob[1]}
+                    append_checkpoint(checkpoint_file, record)
+    finally:
+        release_shared(obs_blocks + schedule_blocks + [setup_block])
+
+    pool_time = time.time() - lap
+    night_timer.add("probability_pass", pool_time, len(todo))
+    print(f"Finished with the pool! [{pool_time:1.1f}s]")
+
+    # report how much of the time each worker spent busy
+    if len(busy_time) > 0:
+        utilisation = np.array(list(busy_time.values())) / pool_time if pool_time > 0 else np.zeros(1)
+        print(f"Worker utilisation: mean {utilisation.mean():1.1%}, min {utilisation.min():1.1%}, "
+              f"max {utilisation.max():1.1%} ({len(busy_time)} workers)")
+
+    # combine the stages of every object and save everything for this night
+    if save_results:
+        totals = StageTimer()
+        for stages in object_timings.values():
+            totals.merge(stages)
+        save_timings(os.path.join(out_path, f"night{night_start}_timings.json"), night=night_start,
+                     n_objects=len(unique_objs), n_resumed=len(unique_objs) - len(todo),
+                     night_stages=night_timer.summary(), object_stages=totals.summary(),
+                     worker_busy_time={str(worker): busy for worker, busy in busy_time.items()},
+                     objects=object_timings)
+
+    if criteria is not None:
+        # objects only count for the criteria that their score passes
+        probs = np.array(probs, dtype=float).reshape(len(unique_objs), len(criteria))
+        scores = sorted_obs.groupby(level=0)["scores"].max().reindex(unique_objs).values
+        probs[scores[:, None] < np.array([c["min_score"] for c in criteria])] = np.nan
+        if save_results:
+            sweep_path = os.path.join(out_path, f"night{night_start}_sweep.h5")
+            pd.DataFrame(probs, index=unique_objs).to_hdf(sweep_path, key="df")
+            pd.DataFrame(criteria).to_hdf(sweep_path, key="criteria")
+            if use_checkpoint and os.path.exists(checkpoint_path):
+                os.remove(checkpoint_path)
+        return probs, unique_objs
+
+    if sampling != "grid":
+        probs, details = [p for p, _ in probs], pd.DataFrame([d for _, d in probs], index=unique_objs)
+        print(f"Used {details['n_orbits'].sum()} orbits in total")
+        if save_results:
+            details.to_hdf(os.path.join(out_path, f"night{night_start}_prob_details.h5"), key="df")
 
     if save_results:
         np.save(os.path.join(out_path, f"night{night_start}_probs.npy"), (probs, unique_objs))
 
+        # everything is safely saved so the checkpoint is no longer needed
+        if use_checkpoint and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
     return probs, unique_objs
 
 
+def prepare_schedule(night_start, detection_window=15, schedule_type="predicted",
+                     schedule_path="/epyc/projects/neocp-predictions/output/predicted_schedules/"):
+    """Get the schedule for the detection window starting on a night, along with the length of each night and
+    the time of its first visit
+
+    Parameters
+    ----------
+    night_start : `int`
+        Night of the initial observations
+    detection_window : `int`, optional
+        How many days in the detection window, by default 15
+    schedule_type : `str`, optional
+        Which schedule to use, either "predicted" or "actual" (see `scheduling.get_LSST_schedule`), by default
+        "predicted"
+    schedule_path : `str`, optional
+        Folder containing the schedule databases
+
+    Returns
+    -------
+    full_schedule : `pandas DataFrame`
+        Every visit in the detection window
+    night_list : `list`
+        The nights in the detection window
+    night_lengths : `array`
+        Length of each night of observations in days
+    first_visit_times : `array`
+        Time of the first visit of each night
+    """
+    # create a list of nights in the detection window and get schedule for them
+    night_list = list(range(night_start, night_start + detection_window))
+
+    if schedule_type == "predicted":
+        full_schedule, summary = get_LSST_schedule(night=night_start, schedule_type=schedule_type,
+                                                   night_zero=NIGHT_ZERO, schedule_path=schedule_path,
+                                                   return_summary=True)
+    else:
+        full_schedule, summary = get_LSST_schedule(night=(night_start, night_start + detection_window - 1),
+                                                   schedule_type=schedule_type, night_zero=NIGHT_ZERO,
+                                                   schedule_path=schedule_path, return_summary=True)
+
+    # offset the schedule by one row to get the previous night column
+    full_schedule["previousNight"] = full_schedule["night"].shift()
+
+    # the length of each night in days (nights that have no observations due to bad weather/downtime are 0)
+    # and the first visit from each night are taken from the (cached) summary of the schedule
+    night_lengths = summary["length"].reindex(night_list, fill_value=0.0).values
+    first_visit_times = summary["first_visit"].values.astype(float)
+
+    return full_schedule, night_list, night_lengths, first_visit_times
+
+
+def get_detection_probabilities_multi(nights, pool_size=48,
+                                      in_path="/epyc/projects/neocp-predictions/output/synthetic_obs/",
+                                      **kwargs):
+    """Run `get_detection_probabilities` for a series of consecutive nights, keeping the worker pool, the
+    observation tables in the sliding window and the detection nights loaded between nights
+
+    Parameters
+    ----------
+    nights : `list`
+        Nights to run (in order)
+    pool_size : `int`, optional
+        How many workers to put in the multiprocessing pool, by default 48
+    in_path : `str`, optional
+        Folder containing the observation files
+    **kwargs
+        Any other arguments to pass to `get_detection_probabilities`
+
+    Returns
+    -------
+    results : `dict`
+        The `(probs, unique_objs)` of each night
+    """
+    obs_cache = {}
+    detection_nights = pd.read_hdf(os.path.join(in_path, "findable_obs_year_1.h5"))
+
+    # the workers need to share our resource tracker (which is only started once something is put in shared
+    # memory) or they'll each try to clean up every night's shared tables themselves
+    resource_tracker.ensure_running()
+
+    results = {}
+    with Pool(pool_size) as pool:
+        for night in nights:
+            print(f"\nStarting night {night}")
+            start = time.time()
+            results[night] = get_detection_probabilities(night_start=night, pool_size=pool_size,
+                                                         in_path=in_path, pool=pool, obs_cache=obs_cache,
+                                                         detection_nights=detection_nights, **kwargs)
+            print(f"Time for this run: {time.time() - start:1.1f}s")
+    return results
+
+
+def _attach_shared(shared):
+    """Attach a pool worker to the shared observation and schedule tables of a night (see
+    `share_dataframe`) and index the schedule's fields, this only happens for the first task of each night
+    since the tables are kept for later tasks"""
+    key = tuple(handle["index"][1]["name"] for handle in shared)
+    if _WORKER_TABLES.get("key") == key:
+        return
+
+    # let go of the previous night's tables (the parent has already removed them)
+    blocks = _WORKER_TABLES.get("blocks", [])
+    _WORKER_TABLES.clear()
+    gc.collect()
+    for block in blocks:
+        try:
+            block.close()
+        except BufferError:
+            # something still has a view of it, it'll be closed once that is collected
+            pass
+
+    _WORKER_TABLES["sorted_obs"], obs_blocks = attach_dataframe(shared[0])
+    _WORKER_TABLES["full_schedule"], schedule_blocks = attach_dataframe(shared[1])
+    _WORKER_TABLES["blocks"] = obs_blocks + schedule_blocks
+    _WORKER_TABLES["field_index"] = FieldIndex(_WORKER_TABLES["full_schedule"])
+    _WORKER_TABLES["key"] = key
+
+
+def _attach_setup(setup_name):
+    """Load the settings of a night (see `share_object`) in a pool worker and attach its tables (see
+    `_attach_shared`), this only happens for the first task of each night since they are kept for later
+    tasks"""
+    if _WORKER_TABLES.get("setup_name") != setup_name:
+        setup = attach_object(setup_name)
+        _attach_shared(setup.pop("shared"))
+        _WORKER_TABLES["setup"], _WORKER_TABLES["setup_name"] = setup, setup_name
+    return _WORKER_TABLES["setup"]
+
+
+def _reachable_from_shared(hex_id, setup_name):
+    """Get the row numbers of the reachable schedule of an object in a pool worker (see `_attach_setup`), as
+    well as the timing record of that stage"""
+    kwargs = _attach_setup(setup_name)["reachable"]
+    timer = StageTimer()
+    with timer.stage("reachable_schedule"):
+        reachable_schedule = get_reachable_schedule(_WORKER_TABLES["sorted_obs"].loc[hex_id],
+                                                    full_schedule=_WORKER_TABLES["full_schedule"],
+                                                    field_index=_WORKER_TABLES["field_index"], **kwargs)
+    timer.count("reachable_schedule", len(reachable_schedule))
+    return reachable_schedule.index.values, timer.summary()
+
+
+def _probability_from_shared(task, setup_name):
+    """Run `probability_from_id` in a pool worker with the settings and tables of `_attach_setup`. `task` is
+    the position of the object in the results, its ID, the row numbers of its reachable schedule and the
+    nights of its prior observations. Also returns the worker's process ID and how long the object took so
+    that the utilisation can be tracked, as well as the timing record of each stage."""
+    start = time.time()
+    i, hex_id, reachable_visits, prior_nights = task
+    kwargs = _attach_setup(setup_name)["probability"]
+    full_schedule = _WORKER_TABLES["full_schedule"]
+    timer = StageTimer()
+    prob = probability_from_id(hex_id, sorted_obs=_WORKER_TABLES["sorted_obs"], full_schedule=full_schedule,
+                               prior_obs_nights={hex_id: prior_nights},
+                               reachable_schedule=full_schedule.iloc[reachable_visits], timer=timer, **kwargs)
+    return i, prob, os.getpid(), time.time() - start, timer.summary()
+
+
 def probability_from_id(hex_id, sorted_obs, distances, radial_velocities, prior_obs_nights, first_visit_times,
                         full_schedule, night_lengths, night_list, detection_window=15, min_nights=3,
-                        ret_joined_table=False, verbose=False,
-                        fov_map_path="/epyc/ssd/users/tomwagg/rubin_sim_data/maf/fov_map.npz"):
+                        sampling="grid", coarse_step=5, batch_size=50, prob_tol=0.05, orbits_per_chunk=None,
+                        seed=None, ret_joined_table=False, verbose=False,
+                        fov_map_path="/epyc/ssd/users/tomwagg/rubin_sim_data/maf/fov_map.npz",
+                        observatory=None, reachable_schedule=None, criteria=None, timer=None):
     """Get the probability of an object with a particular ID of being detected by LSST alone given
     observations on a single night.
 
@@ -201,131 +520,342 @@ def probability_from_id(hex_id, sorted_obs, distances, radial_velocities, prior_
         Length of the detection window in days, by default 15
     min_nights : `int`, optional
         Minimum number of nights required for a detection, by default 3
+    sampling : `str`, optional
+        How to sample the grid of distances and radial velocities. Either "grid" (every point), "adaptive"
+        (coarse-to-fine, see `variant_orbits.adaptive_grid_sample`) or "sequential" (random batches until the
+        probability is known to within `prob_tol`, see `variant_orbits.sequential_grid_sample`), by default
+        "grid"
+    coarse_step : `int`, optional
+        Spacing of the initial coarse grid for adaptive sampling, by default 5
+    batch_size : `int`, optional
+        Number of orbits in each batch for sequential sampling, by default 50
+    prob_tol : `float`, optional
+        Target half-width of the 95% interval on the probability for sequential sampling, by default 0.05
+    orbits_per_chunk : `int`, optional
+        If given, ephemerides are generated for this many orbits at a time and each chunk is reduced to
+        whether each orbit is findable before the next is made, which bounds the memory use, by default None
+        (all orbits at once)
+    seed : `int/SeedSequence`, optional
+        Seed for the random numbers (astrometric scatter and sampling order), the stream for this object is
+        derived from it and `hex_id` (see `object_seed`), by default None (the global `np.random` state)
+    observatory : `ObservatoryEphemeris`, optional
+        Precomputed observatory table for the observer positions, by default None
+    reachable_schedule : `pandas DataFrame`, optional
+        Visits that the object could reach if they have already been found (see `get_reachable_schedule`), by
+        default None (found here)
+    criteria : `list` of `dict`, optional
+        Sets of "detection_window" and "min_nights" to evaluate against the same ephemerides (each window must
+        be no longer than `detection_window`), only for "grid" sampling. By default None (just use
+        `detection_window` and `min_nights`)
+    timer : `StageTimer`, optional
+        Records the time spent in each stage (see `instrumentation.StageTimer`), by default None (not kept)
 
     Returns
     -------
     probs : `list`
-        Estimated probability that the object will be detected by LSST alone
+        Estimated probability that the object will be detected by LSST alone (an array with one for each set
+        of `criteria` if given)
+    details : `dict`
+        Only returned if `sampling` is not "grid". The number of orbits that were evaluated ("n_orbits") and
+        either the estimated error on the probability ("prob_err", adaptive) or the bounds of its 95% interval
+        ("prob_lower", "prob_upper", sequential)
     """
+    if sampling not in ["grid", "adaptive", "sequential"]:
+        raise ValueError(f"Invalid value for `sampling`: {sampling}")
+    if criteria is not None and sampling != "grid":
+        raise ValueError(f"Invalid value for `sampling`: {sampling} (`criteria` requires 'grid')")
+
+    def result(prob, details=None, joined_table=None):
+        if criteria is not None and np.ndim(prob) == 0:
+            prob = np.repeat(prob, len(criteria))
+        if details is None:
+            details = {"n_orbits": 0, "prob_err": 0.0} if sampling == "adaptive"\
+                else {"n_orbits": 0, "prob_lower": prob, "prob_upper": prob}
+        out = (prob, details) if sampling != "grid" else (prob,)
+        if ret_joined_table:
+            out += (joined_table,)
+        return out if len(out) > 1 else out[0]
+
+    timer = StageTimer() if timer is None else timer
+
     # get the matching rows and ephemerides for start of each night
     rows = sorted_obs.loc[hex_id]
-    reachable_schedule = get_reachable_schedule(rows, first_visit_times, night_list,
-                                                night_lengths, full_schedule)
-    
+    if reachable_schedule is None:
+        with timer.stage("reachable_schedule"):
+            reachable_schedule = get_reachable_schedule(rows, first_visit_times, night_list,
+                                                        night_lengths, full_schedule, observatory=observatory)
+        timer.count("reachable_schedule", len(reachable_schedule))
+
     # if nothing is reachable then instantly return 0
     if len(reachable_schedule) == 0:
-        return 0.0
+        return result(0.0)
 
     v_mags = [convert_colour_mags(r["observedTrailedSourceMag"],
                                   in_colour=r["optFilter"], out_colour="V") for _, r in rows.iterrows()]
     apparent_mag = np.mean(v_mags)
+    n_points = len(distances) * len(radial_velocities)
+
+    # separate streams for the scatter (a fixed seed, so each orbit gets the same scatter in every call) and
+    # for the order of sequential sampling
+    scatter_seed, order_rng = None, None
+    if seed is not None:
+        scatter_seed, order_seed = object_seed(seed, hex_id).spawn(2)
+        order_rng = np.random.default_rng(order_seed)
+
+    def findability(grid_points=None):
+        # get the orbits for the entire reachable schedule with the grid of distances and RVs
+        chunks = variant_orbit_ephemerides_chunks(ra=rows.iloc[0]["AstRA(deg)"] * u.deg,
+                                                  dec=rows.iloc[0]["AstDec(deg)"] * u.deg,
+                                                  ra_end=rows.iloc[-1]["AstRA(deg)"] * u.deg,
+                                                  dec_end=rows.iloc[-1]["AstDec(deg)"] * u.deg,
+                                                  delta_t=(rows.iloc[-1]["FieldMJD_TAI"]
+                                                           - rows.iloc[0]["FieldMJD_TAI"]) * u.day,
+                                                  obstime=Time(rows.iloc[0]["FieldMJD_TAI"], format="mjd"),
+                                                  distances=distances,
+                                                  radial_velocities=radial_velocities,
+                                                  apparent_mag=apparent_mag,
+                                                  eph_times=Time(reachable_schedule["observationStartMJD"]
+                                                                 .values.astype(float), format="mjd"),
+                                                  only_neos=True,
+                                                  observatory=observatory,
+                                                  grid_points=grid_points,
+                                                  orbits_per_chunk=orbits_per_chunk or n_points,
+                                                  rng=scatter_seed,
+                                                  num_jobs=1)
+
+        # reduce each chunk to whether each orbit is findable and only keep the ephemerides if asked
+        findable, joined_tables = [], []
+        for ephemerides in timer.iterate("ephemerides", chunks):
+            chunk_findable, joined_table = orbit_findability(hex_id, ephemerides, reachable_schedule,
+                                                             prior_obs_nights,
+                                                             detection_window=detection_window,
+                                                             min_nights=min_nights, fov_map_path=fov_map_path,
+                                                             criteria=criteria, night_start=night_list[0],
+                                                             timer=timer)
+            findable.append(chunk_findable)
+            if ret_joined_table:
+                joined_tables.append(joined_table)
+        return pd.concat(findable), (pd.concat(joined_tables) if ret_joined_table else None)
+
+    if sampling == "grid":
+        findable, joined_table = findability()
+
+        # return the fraction of orbits that are findable (for each set of criteria if there are several)
+        prob = findable.astype(int).sum() / len(findable) if len(findable) > 0 else 0.0
+        if criteria is not None and len(findable) > 0:
+            prob = prob.values
+        details = None
+    else:
+        joined_tables = []
 
-    # get the orbits for the entire reachable schedule with the grid of distances and RVs
-    ephemerides = variant_orbit_ephemerides(ra=rows.iloc[0]["AstRA(deg)"] * u.deg,
-                                            dec=rows.iloc[0]["AstDec(deg)"] * u.deg,
-                                            ra_end=rows.iloc[-1]["AstRA(deg)"] * u.deg,
-                                            dec_end=rows.iloc[-1]["AstDec(deg)"] * u.deg,
-                                            delta_t=(rows.iloc[-1]["FieldMJD_TAI"] - rows.iloc[0]["FieldMJD_TAI"]) * u.day,
-                                            obstime=Time(rows.iloc[0]["FieldMJD_TAI"], format="mjd"),
-                                            distances=distances,
-                                            radial_velocities=radial_velocities,
-                                            apparent_mag=apparent_mag,
-                                            eph_times=Time(reachable_schedule["observationStartMJD"].values.astype(float),
-                                                            format="mjd"),
-                                            only_neos=True,
-                                            num_jobs=1)
+        def evaluate(grid_points):
+            findable, joined_table = findability(grid_points)
+            joined_tables.append(joined_table)
+
+            # orbits without ephemerides were culled as non-NEOs, mark them separately (2)
+            return findable.astype(int).reindex(grid_points, fill_value=2).values
+
+        if sampling == "adaptive":
+            states, evaluated, mismatch_rate = adaptive_grid_sample(len(distances), len(radial_velocities),
+                                                                    evaluate, coarse_step=coarse_step)
+
+            # non-NEOs don't count towards the probability (as in the full grid)
+            n_neo = (states != 2).sum()
+            prob = (states == 1).sum() / n_neo if n_neo > 0 else 0.0
+            details = {"n_orbits": evaluated.sum(),
+                       "prob_err": mismatch_rate * (~evaluated).sum() / n_neo if n_neo > 0 else 0.0}
+        else:
+            states, (lower, upper) = sequential_grid_sample(n_points, evaluate, batch_size=batch_size,
+                                                            tolerance=prob_tol, rng=order_rng)
+            n_neo = np.isin(states, [0, 1]).sum()
+            prob = (states == 1).sum() / n_neo if n_neo > 0 else 0.0
+            details = {"n_orbits": (states != -1).sum(), "prob_lower": lower, "prob_upper": upper}
+        joined_table = pd.concat(joined_tables) if ret_joined_table else None
+
+        if verbose:
+            print(f"{hex_id}: evaluated {details['n_orbits']} of {n_points} grid points")
+
+    if verbose:
+        print(hex_id, prob)
+
+    return result(prob, details, joined_table)
+
+
+def object_seed(seed, hex_id):
+    """Create a seed sequence for an object that depends only on a global seed and its ID, so that results
+    don't depend on which worker (or in which order) objects are run
+
+    Parameters
+    ----------
+    seed : `int/SeedSequence`
+        Global seed
+    hex_id : `str`
+        ID of the object (any string, it doesn't have to be valid hex)
+
+    Returns
+    -------
+    seed_sequence : `numpy SeedSequence`
+        Seed sequence for this object
+    """
+    # keep the spawn key of a seed sequence so that children spawned from the same parent stay independent
+    if isinstance(seed, np.random.SeedSequence):
+        entropy, spawn_key = seed.entropy, tuple(seed.spawn_key)
+    else:
+        entropy, spawn_key = seed, ()
+
+    # a stable hash of the ID (unlike `hash`, which changes between processes)
+    id_key = int.from_bytes(hashlib.blake2b(str(hex_id).encode("utf-8"), digest_size=8).digest(), "little")
+    return np.random.SeedSequence(entropy, spawn_key=spawn_key + (id_key,))
+
+
+def orbit_findability(hex_id, ephemerides, reachable_schedule, prior_obs_nights, detection_window=15,
+                      min_nights=3, fov_map_path="/epyc/ssd/users/tomwagg/rubin_sim_data/maf/fov_map.npz",
+                      criteria=None, night_start=None, timer=None):
+    """Decide whether each variant orbit of an object would be findable by LSST alone
+
+    Parameters
+    ----------
+    hex_id : `str`
+        ID of the object (in hex format)
+    ephemerides : `pandas DataFrame`
+        Ephemerides of the variant orbits at the times of the reachable schedule
+    reachable_schedule : `pandas DataFrame`
+        Visits in the detection window that the object could reach
+    criteria : `list` of `dict`, optional
+        Sets of "detection_window" and "min_nights" to evaluate against the same detections, by default None
+    night_start : `int`, optional
+        Night of the initial observations, only needed for `criteria` (to trim each window), by default None
+    timer : `StageTimer`, optional
+        Records the time spent in each stage, by default None (not kept)
+
+    See `probability_from_id` for the remaining parameters.
+
+    Returns
+    -------
+    findable : `pandas Series/DataFrame`
+        Whether each orbit is findable, indexed by `orbit_id` (with a column for each set of `criteria`)
+    joined_table : `pandas DataFrame`
+        Ephemerides merged with the schedule with whether each was `observed`
+    """
+    timer = StageTimer() if timer is None else timer
     ephemerides["orbit_id"] = ephemerides["orbit_id"].astype(int)
     orbit_ids = ephemerides["orbit_id"].unique()
 
-    # merge the orbits with the schedule
-    joined_table = pd.merge(ephemerides, reachable_schedule,
-                            left_on="mjd_utc", right_on="observationStartMJD")
-    
+    def none_findable():
+        if criteria is None:
+            return pd.Series(np.repeat(False, len(orbit_ids)), index=orbit_ids)
+        return pd.DataFrame(False, index=orbit_ids, columns=range(len(criteria)))
+
+    # every orbit in this chunk was culled so there is nothing to check
+    if len(ephemerides) == 0:
+        return none_findable(), ephemerides.assign(observed=False)
+
+    # the ephemerides were made at the times of the reachable schedule so each row's time index is its visit,
+    # gather the visit of every row rather than joining on the times
+    with timer.stage("merge"):
+        visit_index = ephemerides["time_index"].values.astype(int)
+        visits = reachable_schedule.iloc[visit_index].reset_index(drop=True)
+        joined_table = pd.concat([ephemerides.reset_index(drop=True), visits.assign(visit_index=visit_index)],
+                                 axis=1)
+    timer.count("merge", len(joined_table))
+
     # compute filter magnitudes
-    mag_in_filter = np.ones(len(joined_table)) * np.inf
-    for filter_letter in "ugrizy":
-        filter_mask = joined_table["filter"] == filter_letter
-        if filter_mask.any():
-            mag_in_filter[filter_mask] = convert_colour_mags(joined_table[filter_mask]["VMag"],
-                                                             out_colour=filter_letter,
-                                                             in_colour="V", convention="LSST",
-                                                             asteroid_type="C")
-    joined_table["mag_in_filter"] = mag_in_filter
+    with timer.stage("magnitudes"):
+        mag_in_filter = np.ones(len(joined_table)) * np.inf
+        for filter_letter in "ugrizy":
+            filter_mask = joined_table["filter"] == filter_letter
+            if filter_mask.any():
+                mag_in_filter[filter_mask] = convert_colour_mags(joined_table[filter_mask]["VMag"],
+                                                                 out_colour=filter_letter,
+                                                                 in_colour="V", convention="LSST",
+                                                                 asteroid_type="C")
+        joined_table["mag_in_filter"] = mag_in_filter
+    timer.count("magnitudes", len(joined_table))
 
     # work out which are bright enough to be detected
     bright_enough = joined_table["mag_in_filter"] < joined_table["fiveSigmaDepth"]
 
-    # next we want only objects that are in the camera footprint
-    camera = LsstCameraFootprint(footprint_file=fov_map_path)
-    in_footprint = np.repeat(False, len(joined_table))
-
-    # loop over each of the unique field times
-    unique_field_times = joined_table["mjd_utc"].unique()
-    for field_time in unique_field_times:
-        # get just the table for this time
-        time_mask = joined_table["mjd_utc"] == field_time
-        field_table = joined_table[time_mask]
-        
-        # camera returns indices so we can convert that to a mask like so
-        all_inds = np.arange(len(field_table))
-        observed_inds = camera(field_table["RA_deg"].values, field_table["Dec_deg"].values,
-                               field_table["fieldRA"].iloc[0], field_table["fieldDec"].iloc[0],
-                               field_table["rotSkyPos"].iloc[0])
-        observed_mask = np.isin(all_inds, observed_inds)
-        
-        # add that mask to the overall one
-        in_footprint[time_mask] = observed_mask
+    # next we want only objects that are in the camera footprint, test every row against its visit at once
+    with timer.stage("footprint"):
+        footprint = load_footprint(fov_map_path)
+        rotations = footprint.visit_rotations(reachable_schedule["fieldRA"].values,
+                                              reachable_schedule["fieldDec"].values,
+                                              reachable_schedule["rotSkyPos"].values)
+        in_footprint = footprint.in_footprint(joined_table["RA_deg"].values, joined_table["Dec_deg"].values,
+                                              joined_table["visit_index"].values, rotations)
+    timer.count("footprint", len(joined_table))
 
     # combine the masks into a single observed boolean
     joined_table["observed"] = np.logical_and(in_footprint, bright_enough)
 
     # return if nothing got observed
     if not joined_table["observed"].any():
-        if ret_joined_table:
-            return 0.0, joined_table
-        else:
-            return 0.0
+        return none_findable(), joined_table
 
     # remove any nights that don't match requirements (min_obs, min_arc, max_time)
-    df = joined_table[joined_table["observed"]]
-    mask = df.groupby(["orbit_id", "night"]).apply(filter_tracklets)
-    df_multiindex = df.set_index(["orbit_id", "night"]).sort_index()
-    filtered_obs = df_multiindex.loc[mask[mask].index].reset_index()
+    with timer.stage("tracklet_filter"):
+        filtered_obs = filter_tracklet_groups(joined_table[joined_table["observed"]],
+                                              by=["orbit_id", "night"])
+    timer.count("tracklet_filter", len(filtered_obs))
+
+    prior_nights = np.asarray(prior_obs_nights[hex_id], dtype=int)
+    orbit_nights = filtered_obs["orbit_id"].values, filtered_obs["night"].values.astype(int)
+    with timer.stage("findability"):
+        if criteria is None:
+            findable = pd.Series(findable_orbits(orbit_ids, *orbit_nights, prior_nights,
+                                                 detection_window=detection_window, min_nights=min_nights),
+                                 index=orbit_ids)
+        else:
+            # evaluate each set of criteria against the same detections, only counting nights in its window
+            findable = pd.DataFrame(index=orbit_ids, columns=range(len(criteria)), dtype=bool)
+            for i, c in enumerate(criteria):
+                in_window = orbit_nights[1] < night_start + c["detection_window"]
+                in_prior = prior_nights > night_start - c["detection_window"]
+                findable[i] = findable_orbits(orbit_ids, orbit_nights[0][in_window],
+                                              orbit_nights[1][in_window], prior_nights[in_prior],
+                                              detection_window=c["detection_window"],
+                                              min_nights=c["min_nights"])
+    timer.count("findability", len(orbit_ids))
+    return findable, joined_table
+
+
+def findable_orbits(orbit_ids, detection_orbits, detection_nights, prior_nights, detection_window=15,
+                    min_nights=3):
+    """Decide whether each variant orbit is findable from the nights on which it has valid tracklets
 
-    # decide whether each orbit is findable
-    N_ORB = len(orbit_ids)
-    findable = np.repeat(False, N_ORB)
-    for i, orbit_id in enumerate(orbit_ids):
-        this_orbit = filtered_obs[filtered_obs["orbit_id"] == orbit_id]
-
-        # if the orbit actually exists (if it hasn't been filtered out)
-        if not this_orbit.empty:
-            # combine any prior observations with the predicted ones
-            combined_nights = np.concatenate((prior_obs_nights[hex_id], this_orbit["night"]))
-            unique_nights = np.sort(np.unique(combined_nights))
-
-            # check how many nights it is observed on and require the min nights
-            if len(unique_nights) >= min_nights:
-                # find every window size composed of `min_nights` contiguous nights
-                diff_nights = np.diff(unique_nights)
-                window_sizes = np.array([sum(diff_nights[i:i + min_nights - 1])
-                                        for i in range(len(diff_nights) - min_nights + 2)])
-
-                # record whether any are short enough
-                findable[i] = any(window_sizes <= detection_window)
-
-    # return the fraction of orbits that are findable
-    prob = findable.astype(int).sum() / N_ORB
-    if verbose:
-        print(hex_id, prob)
+    Parameters
+    ----------
+    orbit_ids : `array`
+        IDs of every orbit
+    detection_orbits, detection_nights : `array`
+        Orbit and night of each valid tracklet observation
+    prior_nights : `array`
+        Nights on which the object was observed before the detection window (these count for every orbit that
+        has at least one detection)
+    detection_window : `int`, optional
+        Length of the detection window in days, by default 15
+    min_nights : `int`, optional
+        Minimum number of nights required for a detection, by default 3
 
-    if ret_joined_table:
-        return prob, joined_table
-    else:
-        return prob
+    Returns
+    -------
+    findable : `array`
+        Whether each orbit in `orbit_ids` is findable
+    """
+    # combine any prior observations with the predicted ones of each orbit that hasn't been filtered out
+    observed_orbits = np.unique(detection_orbits)
+    group_ids = np.concatenate((detection_orbits, np.repeat(observed_orbits, len(prior_nights))))
+    nights = np.concatenate((detection_nights, np.tile(prior_nights, len(observed_orbits))))
 
+    # decide whether each orbit is findable
+    groups, findable_groups, _ = findable_windows(group_ids, nights.astype(int), min_nights=min_nights,
+                                                  detection_window=detection_window)
+    return np.isin(orbit_ids, groups[findable_groups])
 
-def get_reachable_schedule(rows, first_visit_times, night_list, night_lengths, full_schedule):
+
+def get_reachable_schedule(rows, first_visit_times, night_list, night_lengths, full_schedule,
+                           observatory=None, field_index=None):
+    # the nominal orbit is not scattered so that the reachable fields don't depend on any random state
     start_orbits = variant_orbit_ephemerides(ra=rows.iloc[0]["AstRA(deg)"] * u.deg,
                                              dec=rows.iloc[0]["AstDec(deg)"] * u.deg,
                                              ra_end=rows.iloc[-1]["AstRA(deg)"] * u.deg,
@@ -336,33 +866,25 @@ def get_reachable_schedule(rows, first_visit_times, night_list, night_lengths, f
                                              distances=[1] * u.AU,
                                              radial_velocities=[2] * u.km / u.s,
                                              eph_times=Time(first_visit_times, format="mjd"),
+                                             sigma_ra=0 * u.arcsecond, sigma_dec=0 * u.arcsecond,
+                                             observatory=observatory,
                                              num_jobs=1)
 
     # create some nominal field size
     FIELD_SIZE = 2.1 * 5
 
-    # mask the schedule to things that can be reached on each night
-    masked_schedules = [pd.DataFrame() for i in range(len(night_list))]
+    # find the visits on each night within a field of the path of the nominal orbit over that night
+    field_index = FieldIndex(full_schedule) if field_index is None else field_index
+    starts, ends = move_along_sky(start_orbits["RA_deg"].values, start_orbits["Dec_deg"].values,
+                                  start_orbits["vRAcosDec"].values, start_orbits["vDec"].values,
+                                  night_lengths[:len(start_orbits)])
+    nights = (start_orbits["mjd_utc"].values - 0.5).astype(int) - NIGHT_ZERO
+    rows = [np.array([], dtype=int) for i in range(len(night_list))]
     for j in range(len(start_orbits)):
-        delta_ra = start_orbits.loc[j]["vRAcosDec"] / np.cos(start_orbits.loc[j]["Dec_deg"] * u.deg)\
-            * night_lengths[j]
-        delta_dec = start_orbits.loc[j]["vDec"] * night_lengths[j]
-
-        ra_lims = sorted([start_orbits.loc[j]["RA_deg"], start_orbits.loc[j]["RA_deg"] + delta_ra.value])
-        ra_lims = [ra_lims[0] - FIELD_SIZE, ra_lims[-1] + FIELD_SIZE]
-        dec_lims = sorted([start_orbits.loc[j]["Dec_deg"], start_orbits.loc[j]["Dec_deg"] + delta_dec])
-        dec_lims = [dec_lims[0] - FIELD_SIZE, dec_lims[-1] + FIELD_SIZE]
-
-        night = (start_orbits.loc[j]["mjd_utc"] - 0.5).astype(int) - NIGHT_ZERO
-
-        mask = full_schedule["night"] == night
-        within_lims = ((full_schedule[mask]["fieldRA"] > ra_lims[0])
-                       & (full_schedule[mask]["fieldRA"] < ra_lims[1])
-                       & (full_schedule[mask]["fieldDec"] > dec_lims[0])
-                       & (full_schedule[mask]["fieldDec"] < dec_lims[1]))
-        masked_schedules[night_list.index(night)] = full_schedule[mask][within_lims]
+        rows[night_list.index(nights[j])] = field_index.query_path(nights[j], starts[j], ends[j], FIELD_SIZE)
+
     # combine into a single reachable schedule
-    return pd.concat(masked_schedules)
+    return full_schedule.iloc[np.concatenate(rows)]
 
 
 def first_last_pos_from_id(hex_id, sorted_obs, s3m_cart, distances, radial_velocities,
@@ -581,8 +1103,20 @@ def main():
                         help='Path to folder in which to place output')
     parser.add_argument('-f', '--fov-map-path', default="/epyc/ssd/users/tomwagg/rubin_sim_data/maf/fov_map.npz", type=str,
                         help='Path to fov_map file')
+    parser.add_argument('-O', '--observatory-path', default=None, type=str,
+                        help='Path to folder containing a precomputed observatory table')
+    parser.add_argument('-a', '--sampling', default="grid", type=str,
+                        choices=["grid", "adaptive", "sequential"],
+                        help='How to sample the distance/radial velocity grid')
+    parser.add_argument('-c', '--orbits-per-chunk', default=None, type=int,
+                        help='How many variant orbits to generate ephemerides for at once (bounds memory)')
+    parser.add_argument('-r', '--seed', default=None, type=int,
+                        help='Random seed (each object gets its own stream derived from it)')
     parser.add_argument('-s', '--start-night', default=0, type=int,
                         help='First night to run')
+    parser.add_argument('-e', '--end-night', default=None, type=int,
+                        help='Last night to run (if given, every night from the start night is run with one '
+                             'pool)')
     parser.add_argument('-mn', '--min-nights', default=3, type=int,
                         help='Minimum number of nights to get detection')
     parser.add_argument('-w', '--detection-window', default=15, type=int,
@@ -593,11 +1127,15 @@ def main():
                         help="Whether to save results")
     args = parser.parse_args()
 
-    get_detection_probabilities(night_start=args.start_night,
-                                detection_window=args.detection_window, min_nights=args.min_nights,
-                                schedule_type="predicted", pool_size=args.pool_size, in_path=args.in_path,
-                                out_path=args.out_path, fov_map_path=args.fov_map_path,
-                                save_results=args.save_results)
+    kwargs = dict(detection_window=args.detection_window, min_nights=args.min_nights,
+                  schedule_type="predicted", pool_size=args.pool_size, in_path=args.in_path,
+                  out_path=args.out_path, fov_map_path=args.fov_map_path,
+                  observatory_path=args.observatory_path, sampling=args.sampling,
+                  orbits_per_chunk=args.orbits_per_chunk, seed=args.seed, save_results=args.save_results)
+    if args.end_night is None:
+        get_detection_probabilities(night_start=args.start_night, **kwargs)
+    else:
+        get_detection_probabilities_multi(range(args.start_night, args.end_night + 1), **kwargs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,35 @@
+import argparse
+import json
+import os
+
+import sys
+sys.path.append("../src")
+
+from footprint import validate_footprint
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Check the vectorised camera footprint against rubin_sim')
+    parser.add_argument('-f', '--fov-map-path',
+                        default="/epyc/ssd/users/tomwagg/rubin_sim_data/maf/fov_map.npz",
+                        type=str, help='Path to fov_map file')
+    parser.add_argument('-o', '--out-file', default="../output/footprint_validation.json", type=str,
+                        help='Path to the JSON file in which to record the result')
+    parser.add_argument('-p', '--n-points', default=10000, type=int, help='Number of points per visit')
+    parser.add_argument('-v', '--n-visits', default=20, type=int, help='Number of random visits')
+    parser.add_argument('-S', '--seed', default=42, type=int, help='Random seed')
+    args = parser.parse_args()
+
+    n_disagree = validate_footprint(args.fov_map_path, n_points=args.n_points, n_visits=args.n_visits,
+                                    seed=args.seed)
+    result = {"fov_map_path": os.path.abspath(args.fov_map_path), "n_points": args.n_points,
+              "n_visits": args.n_visits, "seed": args.seed, "n_disagree": n_disagree}
+    print(f"{n_disagree} of {args.n_points * args.n_visits} points disagree with rubin_sim")
+
+    with open(args.out_file, "w") as f:
+        json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
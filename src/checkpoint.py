@@ -0,0 +1,79 @@
+import json
+import os
+
+
+def _to_json(x):
+    """Convert numpy types into python types for JSON"""
+    return x.tolist()
+
+
+def start_checkpoint(path, config):
+    """Create a new (empty) checkpoint file, replacing any existing one, that starts with a header record of
+    the settings that its results were calculated with
+
+    Parameters
+    ----------
+    path : `str`
+        Path to the checkpoint file
+    config : `dict`
+        Settings of the run (anything that changes the results), these must be convertible to JSON
+    """
+    with open(path, "w") as f:
+        f.write(json.dumps({"config": config}, default=_to_json) + "\n")
+
+
+def read_checkpoint(path, config=None):
+    """Read the results saved so far in an append-only checkpoint file (see `append_checkpoint`). A line that
+    was only partly written (e.g. because the job was killed) is ignored.
+
+    Parameters
+    ----------
+    path : `str`
+        Path to the checkpoint file
+    config : `dict`, optional
+        Settings of the current run, if these don't match the header of the file (see `start_checkpoint`) then
+        none of its results are used, by default None (don't check)
+
+    Returns
+    -------
+    records : `dict`
+        The saved record of each object, keyed by hex_id (empty if the file doesn't exist or doesn't match)
+    """
+    records = {}
+    if not os.path.exists(path):
+        return records
+
+    header = None
+    with open(path) as f:
+        for line in f:
+            if not line.endswith("\n"):
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "config" in record:
+                header = record["config"]
+            else:
+                records[record["hex_id"]] = record
+
+    # compare after a round trip through JSON so that e.g. tuples and numpy types match what was saved
+    if config is not None and header != json.loads(json.dumps(config, default=_to_json)):
+        print(f"Ignoring checkpoint {path} because it was made with different settings")
+        return {}
+    return records
+
+
+def append_checkpoint(f, record):
+    """Add the record of an object to an open checkpoint file, one JSON object per line. The file is flushed
+    so that the record survives the process being killed.
+
+    Parameters
+    ----------
+    f : `file`
+        Checkpoint file opened for appending
+    record : `dict`
+        Record to save, must contain "hex_id" (numpy scalars are converted to python types)
+    """
+    f.write(json.dumps(record, default=_to_json) + "\n")
+    f.flush()
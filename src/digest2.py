@@ -1,8 +1,102 @@
+import erfa
+import numpy as np
 import pandas as pd
 from astropy.coordinates import Angle
 from astropy.time import Time
 from os.path import isfile, join
 
+
+def _digits(values, width):
+    """Zero-padded decimal digits of non-negative integers (less than `10**width`) as fixed-width strings"""
+    powers = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    codes = (values[:, None] // powers % 10 + ord("0")).astype(np.uint8)
+    return codes.view(f"S{width}").ravel().astype(f"U{width}")
+
+
+def _format_fixed(values, width, precision):
+    """Format an array of floats in the same way as `f"{value:0{width}.{precision}f}"` without a python loop.
+
+    Each value is rounded as an integer number of the last decimal place, which is the same as the
+    (correctly rounded) string formatting unless the value is within rounding error of half way between two
+    outputs. Those, and any negative, non-finite or too wide values, are formatted one at a time instead so
+    that the result is identical.
+    """
+    values = np.asarray(values, dtype=float)
+    whole_width = max(width - precision - 1, 1) if precision > 0 else width
+    scaled = values * 10**precision
+    exact = (np.isfinite(scaled) & ~np.signbit(values) & (scaled < 10**(whole_width + precision) - 1)
+             & (np.abs(scaled - np.floor(scaled) - 0.5) > 1e-6))
+
+    whole, fraction = np.divmod(np.rint(np.where(exact, scaled, 0)).astype(np.int64), 10**precision)
+    strings = _digits(whole, whole_width)
+    if precision > 0:
+        strings = np.char.add(np.char.add(strings, "."), _digits(fraction, precision))
+
+    if not exact.all():
+        strings = strings.astype(object)
+        strings[~exact] = [f"{value:0{width}.{precision}f}" for value in values[~exact]]
+        strings = strings.astype(str)
+    return strings
+
+
+def format_digest2_input(nightly_obs):
+    """Write observations as lines in the MPC 80 column format for digest2, all at once from the columns
+
+    Parameters
+    ----------
+    nightly_obs : `pandas DataFrame`
+        Observations with columns "hex_id", "FieldMJD_TAI", "AstRA(deg)", "AstDec(deg)",
+        "observedTrailedSourceMag" and "optFilter"
+
+    Returns
+    -------
+    lines : `str`
+        The observations in the 80 column format (one line per observation, each ending in a new line)
+    """
+    if len(nightly_obs) == 0:
+        return ""
+
+    # convert RA and Dec to hourangles and MJD to regular dates (rounded to the same microsecond as
+    # `datetime`)
+    ra_degrees = Angle(nightly_obs["AstRA(deg)"], unit="deg").hms
+    dec_degrees = Angle(nightly_obs["AstDec(deg)"], unit="deg").dms
+    mjd = nightly_obs["FieldMJD_TAI"].values.astype(float)
+    times = Time(mjd, format="mjd")
+    years, months, days, _ = erfa.d2dtf(times.scale.upper().encode("ascii"), 6, times.jd1, times.jd2)
+
+    # match to 80 column format: https://www.minorplanetcenter.net/iau/info/OpticalObs.html
+    columns = [
+        # each line starts with 5 spaces and then the hex representation of the ID
+        " " * 5, nightly_obs["hex_id"].to_numpy(dtype=str),
+
+        # add two spaces and a C (the C is important for some reason)
+        " " * 2 + "C",
+
+        # convert time to YYYY MM DD.ddddd format
+        np.char.rjust(years.astype(str), 4), " ", _format_fixed(months, 2, 0), " ",
+        _format_fixed(days + mjd % 1.0, 8, 5), " ",
+
+        # convert RA to HH MM SS.ddd
+        _format_fixed(ra_degrees.h, 2, 0), " ", _format_fixed(ra_degrees.m, 2, 0), " ",
+        _format_fixed(ra_degrees.s, 6, 3),
+
+        # convert Dec to sDD MM SS.dd
+        np.where(np.signbit(dec_degrees.d), "-", "+"), _format_fixed(np.abs(dec_degrees.d), 2, 0), " ",
+        _format_fixed(np.abs(dec_degrees.m), 2, 0), " ", _format_fixed(np.abs(dec_degrees.s), 5, 2),
+
+        # leave some blank columns and add the magnitude and filter (right aligned)
+        " " * 9, _format_fixed(nightly_obs["observedTrailedSourceMag"], 4, 1), " " * 2,
+        nightly_obs["optFilter"].to_numpy(dtype=str),
+
+        # add some more spaces and an observatory code
+        " " * 5 + "I11" + "\n"
+    ]
+    lines = columns[0]
+    for column in columns[1:]:
+        lines = np.char.add(lines, column)
+    return "".join(lines.tolist())
+
+
 def create_digest2_input(night=None, file_name=None,
                          in_path="/epyc/projects/neocp-predictions/output/synthetic_obs/",
                          out_path="/epyc/projects/neocp-predictions/output/digest2_input/"):
@@ -27,40 +121,6 @@ def create_digest2_input(night=None, file_name=None,
         print(f"Skipping {file_name} because it already exists")
         return
 
-    # convert RA and Dec to hourangles and MJD to regular dates
-    ra_degrees = Angle(nightly_obs["AstRA(deg)"], unit="deg").hms
-    dec_degrees = Angle(nightly_obs["AstDec(deg)"], unit="deg").dms
-    datetimes = Time(nightly_obs["FieldMJD_TAI"], format="mjd").datetime
-
-    # match to 80 column format: https://www.minorplanetcenter.net/iau/info/OpticalObs.html
-    # each line stars with 5 spaces
-    lines = [" " * 5 for _ in range(len(nightly_obs))]
-    for i in range(len(nightly_obs)):
-        # convert ID to its hex representation
-        lines[i] += nightly_obs.iloc[i]["hex_id"]
-
-        # add two spaces and a C (the C is important for some reason)
-        lines[i] += " " * 2 + "C"
-
-        # convert time to HH MM DD.ddddd format
-        t = datetimes[i]
-        lines[i] += "{:4.0f} {:02.0f} {:08.5f} ".format(t.year, t.month, t.day + nightly_obs.iloc[i]["FieldMJD_TAI"] % 1.0)
-
-        # convert RA to HH MM SS.ddd
-        lines[i] += "{:02.0f} {:02.0f} {:06.3f}".format(ra_degrees.h[i], ra_degrees.m[i], ra_degrees.s[i])
-
-        # convert Dec to sDD MM SS.dd
-        lines[i] += f"{dec_degrees.d[i]:+03.0f} {abs(dec_degrees.m[i]):02.0f} {abs(dec_degrees.s[i]):05.2f}"
-
-        # leave some blank columns
-        lines[i] += " " * 9
-
-        # add the magnitude and filter (right aligned)
-        lines[i] += "{:04.1f}  {}".format(nightly_obs.iloc[i]["observedTrailedSourceMag"], nightly_obs.iloc[i]["optFilter"])
-
-        # add some more spaces and an observatory code
-        lines[i] += " " * 5 + "I11" + "\n"
-
-    # write that to a file
+    # write every line in the 80 column format at once
     with open(join(out_path, out_file_name), "w") as obs_file:
-        obs_file.writelines(lines)
+        obs_file.write(format_digest2_input(nightly_obs))
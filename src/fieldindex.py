@@ -0,0 +1,138 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def radec_to_unit(ra, dec):
+    """Convert positions on the sky (in degrees) into unit vectors with shape (N, 3)"""
+    ra, dec = np.radians(np.atleast_1d(ra)), np.radians(np.atleast_1d(dec))
+    return np.stack((np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)), axis=-1)
+
+
+def _chord(angle):
+    """Straight-line distance between two unit vectors separated by `angle` radians"""
+    return 2 * np.sin(np.minimum(angle, np.pi) / 2)
+
+
+def move_along_sky(ra, dec, v_ra_cosdec, v_dec, dt):
+    """Move positions along great circles at a constant on-sky velocity (which is correct across RA = 0 and
+    over the poles, unlike adding the velocity to RA/Dec)
+
+    Parameters
+    ----------
+    ra, dec : `float/array`
+        Starting positions in degrees
+    v_ra_cosdec, v_dec : `float/array`
+        On-sky velocity in degrees per unit of `dt`
+    dt : `float/array`
+        How long to move for
+
+    Returns
+    -------
+    start, end : `array`
+        Unit vectors of the starting and final positions, each with shape (N, 3)
+    """
+    start = radec_to_unit(ra, dec)
+    ra, dec = np.radians(np.atleast_1d(ra)), np.radians(np.atleast_1d(dec))
+    east = np.stack((-np.sin(ra), np.cos(ra), np.zeros_like(ra)), axis=-1)
+    north = np.stack((-np.sin(dec) * np.cos(ra), -np.sin(dec) * np.sin(ra), np.cos(dec)), axis=-1)
+
+    # rotate each start towards its direction of motion by the distance travelled
+    tangent = np.atleast_1d(v_ra_cosdec)[:, None] * east + np.atleast_1d(v_dec)[:, None] * north
+    speed = np.linalg.norm(tangent, axis=-1)
+    angle = np.radians(speed * np.atleast_1d(dt))[:, None]
+    direction = np.divide(tangent, speed[:, None], out=np.zeros_like(tangent), where=speed[:, None] > 0)
+    return start, np.cos(angle) * start + np.sin(angle) * direction
+
+
+def distance_to_arc(points, start, end):
+    """Angular distance (in radians) from points to the shorter great-circle arc between two unit vectors
+
+    Parameters
+    ----------
+    points : `array`
+        Unit vectors with shape (N, 3)
+    start, end : `array`
+        Unit vectors of the ends of the arc
+
+    Returns
+    -------
+    distance : `array`
+        Distance from each point to the nearest point on the arc
+    """
+    to_ends = np.minimum(np.arccos(np.clip(points @ start, -1, 1)), np.arccos(np.clip(points @ end, -1, 1)))
+    normal = np.cross(start, end)
+    norm = np.linalg.norm(normal)
+    if norm == 0:
+        return to_ends
+    normal /= norm
+
+    # the nearest point on the full great circle is on the arc if it is between the two ends
+    projected = points - np.outer(points @ normal, normal)
+    between = (np.cross(start, projected) @ normal >= 0) & (np.cross(projected, end) @ normal >= 0)
+    to_circle = np.arcsin(np.clip(np.abs(points @ normal), 0, 1))
+    return np.where(between, to_circle, to_ends)
+
+
+class FieldIndex():
+    def __init__(self, schedule, night_col="night", ra_col="fieldRA", dec_col="fieldDec"):
+        """A spatial index of the pointing of each visit in a schedule, with one KD-tree of unit vectors per
+        night so that the visits near a position or path on a given night can be found without checking
+        every visit
+
+        Parameters
+        ----------
+        schedule : `pandas DataFrame`
+            Schedule of visits (e.g. from `scheduling.get_LSST_schedule`)
+        night_col, ra_col, dec_col : `str`, optional
+            Columns containing the night and the pointing (in degrees) of each visit
+        """
+        nights = np.asarray(schedule[night_col].values)
+        unit = radec_to_unit(schedule[ra_col].values, schedule[dec_col].values)
+
+        # row numbers of the visits in each night and a tree of their pointings
+        self.rows, self.trees = {}, {}
+        order = np.argsort(nights, kind="stable")
+        unique_nights, starts = np.unique(nights[order], return_index=True)
+        for night, rows in zip(unique_nights, np.split(order, starts[1:])):
+            self.rows[night] = rows
+            self.trees[night] = cKDTree(unit[rows])
+
+    def query_path(self, night, start, end, radius):
+        """Find the visits on a night whose pointing is within some distance of a great-circle path
+
+        Parameters
+        ----------
+        night : `int`
+            Night on which to look
+        start, end : `array`
+            Unit vectors of the start and end of the path (these can be the same to search a circle)
+        radius : `float`
+            Maximum distance from the path in degrees
+
+        Returns
+        -------
+        rows : `array`
+            Sorted row numbers (positions in the schedule) of the visits within `radius` of the path
+        """
+        if night not in self.trees:
+            return np.array([], dtype=int)
+        tree = self.trees[night]
+        radius = np.radians(radius)
+
+        # cover the path with circles spaced at most `radius` apart, each of which also reaches half way to
+        # the next so that together they contain everything within `radius` of the path
+        length = np.arccos(np.clip(start @ end, -1, 1))
+        n_steps = int(np.ceil(length / radius)) + 1
+        fractions = np.linspace(0, 1, n_steps)[:, None]
+        if length > 0:
+            samples = (np.sin((1 - fractions) * length) * start
+                       + np.sin(fractions * length) * end) / np.sin(length)
+        else:
+            samples = start[None, :]
+        candidates = tree.query_ball_point(samples, _chord(radius + length / (n_steps - 1) / 2
+                                                           if n_steps > 1 else radius))
+        candidates = np.unique(np.concatenate(candidates).astype(int))
+
+        # then keep only those that are actually close enough
+        candidates = candidates[distance_to_arc(tree.data[candidates], start, end) <= radius]
+        return self.rows[night][candidates]
@@ -0,0 +1,56 @@
+import numpy as np
+
+
+def findable_windows(group_ids, nights, min_nights=3, detection_window=15):
+    """Decide whether each group (e.g. an object or a variant orbit) is findable given the nights on which
+    it was observed. A group is findable if any `min_nights` distinct nights fit within `detection_window`
+    nights. Everything is done with sorted segment operations rather than looping over groups.
+
+    Parameters
+    ----------
+    group_ids : `array`
+        Integer ID of the group for each observation
+    nights : `array`
+        Night of each observation (duplicates are fine)
+    min_nights : `int`, optional
+        Minimum number of nights required for a detection, by default 3
+    detection_window : `int`, optional
+        Length of the detection window in nights, by default 15
+
+    Returns
+    -------
+    groups : `array`
+        Each unique group ID (sorted)
+    findable : `array`
+        Whether each group is findable
+    first_night : `array`
+        Night on which each group first becomes findable (the last night of the first window that fits),
+        -1 if it is not findable
+    """
+    group_ids, nights = np.asarray(group_ids), np.asarray(nights)
+
+    # sort by group then night and drop repeated nights so each group is a segment of distinct nights
+    order = np.lexsort((nights, group_ids))
+    group_ids, nights = group_ids[order], nights[order]
+    distinct = np.ones(len(nights), dtype=bool)
+    distinct[1:] = (group_ids[1:] != group_ids[:-1]) | (nights[1:] != nights[:-1])
+    group_ids, nights = group_ids[distinct], nights[distinct]
+
+    # position of each night within its group's segment
+    groups, starts = np.unique(group_ids, return_index=True)
+    position = np.arange(len(nights)) - np.repeat(starts, np.diff(np.append(starts, len(nights))))
+
+    # the window that ends at each night spans the previous `min_nights` distinct nights of the group
+    lag = min_nights - 1
+    window_sizes = np.zeros_like(nights)
+    window_sizes[lag:] = nights[lag:] - nights[:len(nights) - lag]
+    fits = (position >= lag) & (window_sizes <= detection_window)
+
+    # since nights are sorted, the first window that fits in each group gives the detection night
+    findable = np.zeros(len(groups), dtype=bool)
+    first_night = np.full(len(groups), -1, dtype=nights.dtype)
+    found_groups, first = np.unique(group_ids[fits], return_index=True)
+    found = np.searchsorted(groups, found_groups)
+    findable[found] = True
+    first_night[found] = nights[fits][first]
+    return groups, findable, first_night
@@ -0,0 +1,151 @@
+import numpy as np
+
+# footprints that have already been loaded (so each worker only reads the file once)
+_FOOTPRINT_CACHE = {}
+
+
+class CameraFootprint():
+    def __init__(self, footprint_file, max_radius=1.94):
+        """A vectorised version of `rubin_sim.utils.LsstCameraFootprint` that tests every (point, visit) pair
+        at once rather than one visit at a time
+
+        Parameters
+        ----------
+        footprint_file : `str`
+            Path to the `fov_map.npz` file containing the camera footprint image
+        max_radius : `float`, optional
+            Pixels further than this from the boresight (in degrees) are never on the camera, as in
+            `LsstCameraFootprint`, by default 1.94
+        """
+        with np.load(footprint_file) as model_file:
+            self.camera_fov = model_file["image"].astype(bool)
+            self.x_camera = model_file["x"].copy()
+        self.plate_scale = self.x_camera[1] - self.x_camera[0]
+        radius = np.hypot(*np.meshgrid(self.x_camera, self.x_camera, indexing="ij"))
+        self.camera_fov[radius > max_radius] = False
+
+    @staticmethod
+    def visit_rotations(field_ra, field_dec, rot_sky_pos):
+        """Calculate the rotation matrix for each visit that takes a unit vector on the sky into the camera
+        frame (x and y in the focal plane after rotating by `rot_sky_pos`, z along the boresight)
+
+        Parameters
+        ----------
+        field_ra, field_dec : `float/array`
+            Boresight of each visit in degrees
+        rot_sky_pos : `float/array`
+            Sky rotation of each visit in degrees
+
+        Returns
+        -------
+        rotations : `array`
+            Rotation matrices with shape (N, 3, 3)
+        """
+        ra, dec = np.radians(np.atleast_1d(field_ra)), np.radians(np.atleast_1d(field_dec))
+        theta = np.radians(np.atleast_1d(rot_sky_pos))
+
+        # east, north and boresight unit vectors for each visit (the gnomonic projection basis)
+        east = np.stack((-np.sin(ra), np.cos(ra), np.zeros_like(ra)), axis=-1)
+        north = np.stack((-np.sin(dec) * np.cos(ra), -np.sin(dec) * np.sin(ra), np.cos(dec)), axis=-1)
+        boresight = np.stack((np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)), axis=-1)
+
+        cos_theta, sin_theta = np.cos(theta)[:, None], np.sin(theta)[:, None]
+        return np.stack((cos_theta * east - sin_theta * north,
+                         sin_theta * east + cos_theta * north,
+                         boresight), axis=1)
+
+    def in_footprint(self, ra, dec, visit_index, rotations):
+        """Check whether points are on the camera for their visits
+
+        Parameters
+        ----------
+        ra, dec : `float/array`
+            Position of each point in degrees
+        visit_index : `int/array`
+            Index of the visit (into `rotations`) for each point
+        rotations : `array`
+            Rotation matrices for the visits (see `visit_rotations`)
+
+        Returns
+        -------
+        mask : `array`
+            Boolean mask of which points are in the footprint of their visit
+        """
+        ra, dec = np.radians(np.atleast_1d(ra)), np.radians(np.atleast_1d(dec))
+        unit = np.stack((np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)), axis=-1)
+        camera = np.einsum("nij,nj->ni", rotations[visit_index], unit)
+
+        # project onto the focal plane, ignoring anything behind the camera
+        in_front = camera[:, 2] > 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x_proj = np.degrees(camera[:, 0] / camera[:, 2])
+            y_proj = np.degrees(camera[:, 1] / camera[:, 2])
+
+        # look up each position in the footprint image
+        x_ind = np.round((np.where(in_front, x_proj, -np.inf) - self.x_camera[0]) / self.plate_scale)
+        y_ind = np.round((np.where(in_front, y_proj, -np.inf) - self.x_camera[0]) / self.plate_scale)
+        in_range = ((x_ind >= 0) & (x_ind < self.camera_fov.shape[0])
+                    & (y_ind >= 0) & (y_ind < self.camera_fov.shape[1]))
+
+        mask = np.zeros(len(ra), dtype=bool)
+        mask[in_range] = self.camera_fov[x_ind[in_range].astype(int), y_ind[in_range].astype(int)]
+        return mask
+
+
+def load_footprint(footprint_file):
+    """Get the `CameraFootprint` for a file, only reading it the first time it is requested in a process
+
+    Parameters
+    ----------
+    footprint_file : `str`
+        Path to the `fov_map.npz` file
+
+    Returns
+    -------
+    footprint : `CameraFootprint`
+        The camera footprint
+    """
+    if footprint_file not in _FOOTPRINT_CACHE:
+        _FOOTPRINT_CACHE[footprint_file] = CameraFootprint(footprint_file)
+    return _FOOTPRINT_CACHE[footprint_file]
+
+
+def validate_footprint(footprint_file, n_points=10000, n_visits=20, seed=None):
+    """Compare `CameraFootprint` to `rubin_sim.utils.LsstCameraFootprint` for random points near random
+    visits
+
+    Parameters
+    ----------
+    footprint_file : `str`
+        Path to the `fov_map.npz` file
+    n_points : `int`, optional
+        Number of points per visit, by default 10000
+    n_visits : `int`, optional
+        Number of random visits, by default 20
+    seed : `int`, optional
+        Random seed, by default None
+
+    Returns
+    -------
+    n_disagree : `int`
+        Number of points for which the two disagree
+    """
+    try:
+        from rubin_sim.utils import LsstCameraFootprint
+    except ImportError:
+        from rubin_scheduler.utils import LsstCameraFootprint
+    camera = LsstCameraFootprint(footprint_file=footprint_file)
+    footprint = load_footprint(footprint_file)
+
+    rng = np.random.default_rng(seed)
+    field_ra, field_dec = rng.uniform(0, 360, n_visits), rng.uniform(-80, 30, n_visits)
+    rot_sky_pos = rng.uniform(0, 360, n_visits)
+    rotations = footprint.visit_rotations(field_ra, field_dec, rot_sky_pos)
+
+    n_disagree = 0
+    for i in range(n_visits):
+        ra = field_ra[i] + rng.uniform(-3, 3, n_points) / np.cos(np.radians(field_dec[i]))
+        dec = field_dec[i] + rng.uniform(-3, 3, n_points)
+        expected = np.isin(np.arange(n_points), camera(ra, dec, field_ra[i], field_dec[i], rot_sky_pos[i]))
+        n_disagree += (footprint.in_footprint(ra, dec, np.repeat(i, n_points), rotations) != expected).sum()
+    return int(n_disagree)
@@ -0,0 +1,73 @@
+from contextlib import contextmanager
+import json
+import time
+
+
+class StageTimer():
+    def __init__(self):
+        """Record the wall time, number of calls and number of items processed by each stage of a calculation.
+        The records are plain dicts so they can be sent back from pool workers and combined with `merge`."""
+        self.stages = {}
+
+    def add(self, name, elapsed, count=0, calls=1):
+        """Add a call of a stage that took `elapsed` seconds and processed `count` items (or add the time to
+        the stage without counting a call if `calls` is 0)"""
+        record = self.stages.setdefault(name, {"time": 0.0, "calls": 0, "count": 0})
+        record["time"] += elapsed
+        record["calls"] += calls
+        record["count"] += int(count)
+
+    def count(self, name, count):
+        """Add to the number of items processed by a stage (without counting it as a call)"""
+        record = self.stages.setdefault(name, {"time": 0.0, "calls": 0, "count": 0})
+        record["count"] += int(count)
+
+    @contextmanager
+    def stage(self, name):
+        """Time the code in a `with` block as a call of a stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def iterate(self, name, iterable):
+        """Iterate over something that does its work lazily (e.g. a generator of chunks), timing how long each
+        item takes to produce (but not what is done with it) and counting the length of each item. Finding out
+        that there are no more items adds to the time but isn't counted as a call."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, time.perf_counter() - start, calls=0)
+                return
+            self.add(name, time.perf_counter() - start, len(item))
+            yield item
+
+    def merge(self, stages):
+        """Add the records of another timer (or its `stages` dict) to this one"""
+        stages = stages.stages if isinstance(stages, StageTimer) else stages
+        for name, other in stages.items():
+            record = self.stages.setdefault(name, {"time": 0.0, "calls": 0, "count": 0})
+            for key in record:
+                record[key] += other[key]
+
+    def summary(self):
+        """Get a copy of the records of each stage"""
+        return {name: dict(record) for name, record in self.stages.items()}
+
+
+def save_timings(path, **timings):
+    """Save timing records (and anything else that can be written as JSON) to a file
+
+    Parameters
+    ----------
+    path : `str`
+        Path to the JSON file
+    **timings
+        Items to save, numpy types are converted to python types
+    """
+    with open(path, "w") as f:
+        json.dump(timings, f, indent=2, default=lambda x: x.tolist())
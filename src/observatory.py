@@ -0,0 +1,153 @@
+import astropy.units as u
+from astropy.time import Time
+from astropy.coordinates import EarthLocation
+import numpy as np
+import os
+
+from transforms import observer_heliocentric_states
+
+# locations of observatories by MPC code (either astropy site names or EarthLocations)
+OBSERVATORY_LOCATIONS = {
+    "I11": EarthLocation(1820193.06844603, -5208343.03427567, -3194842.50048343, unit="m"),
+    "X05": "Rubin Observatory",
+    "F51": "Haleakala Observatories",
+    "F52": "Haleakala Observatories",
+}
+
+
+def build_observatory_table(path, obs_codes=["I11"], start_mjd=60796 - 60, end_mjd=60796 + 3653 + 60,
+                            step=1 / 24, chunk_size=10000):
+    """Create a table of heliocentric ecliptic observatory states sampled over the whole survey. One file is
+    written per observatory code (`{path}/{obs_code}.npy`) which can then be memory-mapped and interpolated
+    by `ObservatoryEphemeris`.
+
+    Parameters
+    ----------
+    path : `str`
+        Folder in which to save the tables
+    obs_codes : `list`, optional
+        MPC codes of the observatories to include (must be in `OBSERVATORY_LOCATIONS`), by default ["I11"]
+    start_mjd : `float`, optional
+        First MJD (UTC) in the table, by default 60 days before the start of LSST
+    end_mjd : `float`, optional
+        Last MJD (UTC) in the table, by default 60 days after the end of the 10 year LSST baseline
+    step : `float`, optional
+        Spacing of the samples in days, by default 1 hour
+    chunk_size : `int`, optional
+        How many samples to compute at once, by default 10000
+    """
+    os.makedirs(path, exist_ok=True)
+    mjd = np.arange(start_mjd, end_mjd + step, step)
+
+    for obs_code in obs_codes:
+        location = OBSERVATORY_LOCATIONS[obs_code]
+        if isinstance(location, str):
+            location = EarthLocation.of_site(location)
+
+        # columns are mjd, x, y, z, vx, vy, vz
+        table = np.zeros((len(mjd), 7))
+        table[:, 0] = mjd
+        for start in range(0, len(mjd), chunk_size):
+            times = Time(mjd[start:start + chunk_size], format="mjd")
+            table[start:start + chunk_size, 1:] = observer_heliocentric_states(times, location)
+
+        np.save(os.path.join(path, f"{obs_code}.npy"), table)
+
+
+class ObservatoryEphemeris():
+    def __init__(self, path, obs_code="I11"):
+        """A memory-mapped table of observatory states (see `build_observatory_table`) that is queried by
+        cubic Hermite interpolation
+
+        Parameters
+        ----------
+        path : `str`
+            Folder containing the tables
+        obs_code : `str`, optional
+            MPC code of the observatory, by default "I11"
+        """
+        self.path = path
+        self.obs_code = obs_code
+        self._load()
+
+    def _load(self):
+        self.table = np.load(os.path.join(self.path, f"{self.obs_code}.npy"), mmap_mode="r")
+        self.start_mjd = self.table[0, 0]
+        self.step = self.table[1, 0] - self.table[0, 0]
+
+    def __getstate__(self):
+        # only send the path to other processes, they can map the file themselves
+        return {"path": self.path, "obs_code": self.obs_code}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load()
+
+    def states(self, mjd):
+        """Get the heliocentric ecliptic state of the observatory at a series of times
+
+        Parameters
+        ----------
+        mjd : `float/array`
+            Times (UTC MJD) at which to get the states
+
+        Returns
+        -------
+        states : `array`
+            Cartesian states with shape (N, 6) in AU and AU/day
+        """
+        mjd = np.atleast_1d(mjd).astype(float)
+        x = (mjd - self.start_mjd) / self.step
+        i = np.floor(x).astype(int)
+        if np.any(i < 0) or np.any(i >= len(self.table) - 1):
+            raise ValueError(f"Times outside of the observatory table range ({self.start_mjd:1.1f}, "
+                             f"{self.table[-1, 0]:1.1f})")
+
+        # cubic hermite interpolation using the positions and velocities at either side
+        s = (x - i)[:, None]
+        before, after = self.table[i, 1:], self.table[i + 1, 1:]
+        p0, v0, p1, v1 = before[:, :3], before[:, 3:] * self.step, after[:, :3], after[:, 3:] * self.step
+        position = (2 * s**3 - 3 * s**2 + 1) * p0 + (s**3 - 2 * s**2 + s) * v0\
+            + (-2 * s**3 + 3 * s**2) * p1 + (s**3 - s**2) * v1
+        velocity = ((6 * s**2 - 6 * s) * p0 + (3 * s**2 - 4 * s + 1) * v0
+                    + (-6 * s**2 + 6 * s) * p1 + (3 * s**2 - 2 * s) * v1) / self.step
+        return np.hstack((position, velocity))
+
+    def positions(self, mjd):
+        """Get the heliocentric ecliptic position of the observatory (AU) at a series of times (UTC MJD)"""
+        return self.states(mjd)[:, :3]
+
+    def sun_distances(self, mjd):
+        """Get the distance between the observatory and the Sun (AU) at a series of times (UTC MJD)"""
+        return np.linalg.norm(self.positions(mjd), axis=1)
+
+
+def validate_observatory_table(observatory, n_points=1000, seed=None):
+    """Compare the interpolated states from an `ObservatoryEphemeris` to directly computed ones
+
+    Parameters
+    ----------
+    observatory : `ObservatoryEphemeris`
+        Table to check
+    n_points : `int`, optional
+        How many random times to compare, by default 1000
+    seed : `int`, optional
+        Random seed, by default None
+
+    Returns
+    -------
+    max_pos_diff : `float`
+        Largest difference in position (AU)
+    max_vel_diff : `float`
+        Largest difference in velocity (AU/day)
+    """
+    rng = np.random.default_rng(seed)
+    mjd = rng.uniform(observatory.table[0, 0], observatory.table[-2, 0], n_points)
+    location = OBSERVATORY_LOCATIONS[observatory.obs_code]
+    if isinstance(location, str):
+        location = EarthLocation.of_site(location)
+
+    truth = observer_heliocentric_states(Time(mjd, format="mjd"), location)
+    interpolated = observatory.states(mjd)
+    return (np.linalg.norm(truth[:, :3] - interpolated[:, :3], axis=1).max() * u.AU,
+            np.linalg.norm(truth[:, 3:] - interpolated[:, 3:], axis=1).max() * u.AU / u.day)
@@ -1,4 +1,6 @@
+from collections import OrderedDict
 import sqlite3
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import os
@@ -20,11 +22,20 @@ params = {'figure.figsize': (12, 8),
           'ytick.minor.size': 4}
 plt.rcParams.update(params)
 
+# columnar schedule stores that have already been opened (so each process only maps the files once), along
+# with the version of the store that was opened
+_SCHEDULE_STORES = {}
+
+# schedules that have already been loaded, least recently used first (see `get_LSST_schedule`)
+_SCHEDULE_CACHE = OrderedDict()
+_SCHEDULE_CACHE_SIZE = {"max_bytes": 512 * 1024**2, "bytes": 0}
+
 
 def get_LSST_schedule(night, night_zero=60796, schedule_type="predicted",
                       fields=["fieldRA", "fieldDec", "observationStartMJD",
                               "filter", "fiveSigmaDepth", "rotSkyPos"],
-                      schedule_path='/epyc/projects/neocp-predictions/output/predicted_schedules/'):
+                      schedule_path='/epyc/projects/neocp-predictions/output/predicted_schedules/',
+                      cache=True, return_summary=False):
     """Get the schedule for LSST (where it will point at what time)
 
     Parameters
@@ -34,50 +45,328 @@ def get_LSST_schedule(night, night_zero=60796, schedule_type="predicted",
     fields : `list`, optional
         Fields you want from the database, by default ["fieldRA", "fieldDec", "observationStartMJD",
         "filter", "fiveSigmaDepth", "rotSkyPos"]
+    cache : `bool`, optional
+        Whether to keep the schedule in memory for later calls (see `set_schedule_cache_size`), by default
+        True. A range of nights of the "actual" schedule is put together from the cache of each night so that
+        overlapping ranges only load the nights they don't share.
+    return_summary : `bool`, optional
+        Whether to also return the summary of each night (see `summarise_schedule`), by default False
 
     Returns
     -------
     df : `pandas DataFrame`
-        DataFrame containing individual fields
+        DataFrame containing individual fields (a copy, so it can be modified freely)
+    summary : `pandas DataFrame`
+        Summary of each night, only returned if `return_summary`
+
+    If a schedule database has been converted with `build_schedule_store` then the store is read instead.
     """
+    if schedule_type not in ["actual", "predicted"]:
+        raise ValueError(f"Invalid value for `schedule_type`: {schedule_type}")
 
-    if schedule_type == "actual":
-        print(os.path.join(schedule_path, 'baseline_v3.3_1yrs.db'))
-        con = sqlite3.connect(os.path.join(schedule_path, 'baseline_v3.3_1yrs.db'))
-        cur = con.cursor()
+    if not cache:
+        df = _load_LSST_schedule(night, night_zero, schedule_type, fields, schedule_path, cache=False).copy()
+        return (df, summarise_schedule(df)) if return_summary else df
+
+    if schedule_type == "actual" and not isinstance(night, int):
+        # read any nights that aren't cached yet all at once
+        keys = {i: _schedule_key(i, night_zero, schedule_type, fields, schedule_path)
+                for i in range(night[0], night[1] + 1)}
+        missing = [i for i, key in keys.items() if key not in _SCHEDULE_CACHE]
+        if len(missing) > 0:
+            _cache_actual_nights(missing[0], missing[-1], night_zero, fields, schedule_path)
+
+        entries = [_cached_schedule(i, night_zero, schedule_type, fields, schedule_path)
+                   for i in range(night[0], night[1] + 1)]
+        df = pd.concat([entry["schedule"] for entry in entries], ignore_index=True)
+        if not return_summary:
+            return df
+
+        # shift the rows of each night's summary to where it ends up in the combined schedule
+        offsets = np.cumsum([0] + [len(entry["schedule"]) for entry in entries])[:-1]
+        summary = pd.concat([entry["summary"] for entry in entries])
+        shift = np.repeat(offsets, [len(entry["summary"]) for entry in entries])
+        summary["start"] += shift
+        summary["end"] += shift
+
+        # a night that was split between two nights of the database needs to be put back together
+        if summary.index.has_duplicates:
+            summary = summary.groupby(level=0, sort=False).agg({"first_visit": "first",
+                                                                "last_visit": "last", "length": "first",
+                                                                "start": "min", "end": "max"})
+            summary["length"] = summary["last_visit"] - summary["first_visit"]
+        return df, summary
+
+    entry = _cached_schedule(night, night_zero, schedule_type, fields, schedule_path)
+    df = entry["schedule"].copy()
+    return (df, entry["summary"].copy()) if return_summary else df
 
-        if isinstance(night, int):
-            res = cur.execute(f"select {','.join(fields)} from observations where night={night + 1}")
-        else:
-            res = cur.execute(f"select {','.join(fields)} from observations where night between {night[0] + 1} and {night[1] + 1}")
-        df = pd.DataFrame(res.fetchall(), columns=fields)
 
-        con.close()
+def _load_LSST_schedule(night, night_zero, schedule_type, fields, schedule_path, cache=True):
+    """Read the schedule for LSST from the databases (see `get_LSST_schedule`)"""
+    if schedule_type == "actual":
+        print(os.path.join(schedule_path, 'baseline_v3.3_1yrs.db'))
+        first, last = (night, night) if isinstance(night, int) else night
+        df = read_schedule(os.path.join(schedule_path, 'baseline_v3.3_1yrs.db'), first + 1, last + 1, fields)
 
         df["night"] = (df["observationStartMJD"] - 0.5).astype(int) - night_zero
-    elif schedule_type == "predicted":
+    else:
         first_night = get_LSST_schedule(night=night, night_zero=night_zero,
                                         schedule_type="actual", fields=fields,
-                                        schedule_path=schedule_path)
+                                        schedule_path=schedule_path, cache=cache)
 
         print(os.path.join(schedule_path, f'night{night + 1}_15days.db'))
-        con = sqlite3.connect(os.path.join(schedule_path, f'night{night + 1}_15days.db'))
-        cur = con.cursor()
-        res = cur.execute(f"select {','.join(fields)} from observations where night between {night + 2} and {night + 15}")
-        rest = pd.DataFrame(res.fetchall(), columns=fields)
-
-        con.close()
+        rest = read_schedule(os.path.join(schedule_path, f'night{night + 1}_15days.db'),
+                             night + 2, night + 15, fields)
 
         rest["night"] = (rest["observationStartMJD"] - 0.5).astype(int) - night_zero
 
         df = pd.concat([first_night, rest])
         df.reset_index(inplace=True)
-    else:
-        raise ValueError(f"Invalid value for `schedule_type`: {schedule_type}")
 
     return df
 
 
+def _file_version(db_path):
+    """Modification time of a schedule database and of its store (if either exists), so that a schedule that
+    is rebuilt in place isn't served from the cache"""
+    paths = [db_path, os.path.join(os.path.splitext(db_path)[0], "night_offsets.npy")]
+    return tuple(os.stat(path).st_mtime_ns if os.path.exists(path) else None for path in paths)
+
+
+def _schedule_key(night, night_zero, schedule_type, fields, schedule_path):
+    """Key of a schedule in the cache (which includes the version of each file that it is read from)"""
+    db_paths = [os.path.join(schedule_path, 'baseline_v3.3_1yrs.db')]
+    if schedule_type == "predicted":
+        db_paths.append(os.path.join(schedule_path, f'night{night + 1}_15days.db'))
+    return (schedule_type, night if isinstance(night, int) else tuple(night), tuple(fields), night_zero,
+            os.path.abspath(schedule_path), tuple(_file_version(db_path) for db_path in db_paths))
+
+
+def _cached_schedule(night, night_zero, schedule_type, fields, schedule_path):
+    """Get the cache entry of a schedule (and its summary), loading it if it isn't already in the cache"""
+    key = _schedule_key(night, night_zero, schedule_type, fields, schedule_path)
+    if key in _SCHEDULE_CACHE:
+        _SCHEDULE_CACHE.move_to_end(key)
+        return _SCHEDULE_CACHE[key]
+    return _cache_schedule(key, _load_LSST_schedule(night, night_zero, schedule_type, fields, schedule_path))
+
+
+def _cache_schedule(key, df):
+    """Add a schedule (and its summary) to the cache, evicting the least recently used schedules if that takes
+    the cache over its size"""
+    entry = {"schedule": df, "summary": summarise_schedule(df),
+             "nbytes": int(df.memory_usage(deep=True).sum())}
+    _SCHEDULE_CACHE[key] = entry
+    _SCHEDULE_CACHE_SIZE["bytes"] += entry["nbytes"]
+    _evict_schedules()
+    return entry
+
+
+def _cache_actual_nights(first, last, night_zero, fields, schedule_path):
+    """Read a range of nights of the "actual" schedule with a single query and cache each night separately
+    (exactly as if each had been loaded on its own)"""
+    db_path = os.path.join(schedule_path, 'baseline_v3.3_1yrs.db')
+    print(db_path)
+
+    # the opsim night is needed to split the visits up (and is replaced afterwards anyway)
+    df = read_schedule(db_path, first + 1, last + 1,
+                       fields if "night" in fields else list(fields) + ["night"])
+    bounds = np.searchsorted(df["night"].values, np.arange(first + 1, last + 3))
+    df["night"] = (df["observationStartMJD"] - 0.5).astype(int) - night_zero
+
+    for i, start, end in zip(range(first, last + 1), bounds[:-1], bounds[1:]):
+        key = _schedule_key(i, night_zero, "actual", fields, schedule_path)
+        if key not in _SCHEDULE_CACHE:
+            _cache_schedule(key, df.iloc[start:end].reset_index(drop=True))
+
+
+def _evict_schedules():
+    """Remove the least recently used schedules until the cache fits in its size (always keeping the
+    newest)"""
+    while _SCHEDULE_CACHE_SIZE["bytes"] > _SCHEDULE_CACHE_SIZE["max_bytes"] and len(_SCHEDULE_CACHE) > 1:
+        _, entry = _SCHEDULE_CACHE.popitem(last=False)
+        _SCHEDULE_CACHE_SIZE["bytes"] -= entry["nbytes"]
+
+
+def set_schedule_cache_size(max_bytes):
+    """Set how much memory the cache of loaded schedules can use (see `get_LSST_schedule`)
+
+    Parameters
+    ----------
+    max_bytes : `int`
+        Maximum size of the cache in bytes, 0 turns the cache off
+    """
+    if max_bytes < 0:
+        raise ValueError(f"Invalid value for `max_bytes`: {max_bytes}")
+    _SCHEDULE_CACHE_SIZE["max_bytes"] = max_bytes
+    _evict_schedules()
+    if max_bytes == 0:
+        clear_schedule_cache()
+
+
+def clear_schedule_cache():
+    """Remove every schedule from the cache of loaded schedules"""
+    _SCHEDULE_CACHE.clear()
+    _SCHEDULE_CACHE_SIZE["bytes"] = 0
+
+
+def summarise_schedule(df, time_col="observationStartMJD"):
+    """Summarise each night of a (time-ordered) schedule
+
+    Parameters
+    ----------
+    df : `pandas DataFrame`
+        DataFrame of fields (see `get_LSST_schedule`)
+    time_col : `str`, optional
+        Column containing the time of each visit, by default "observationStartMJD"
+
+    Returns
+    -------
+    summary : `pandas DataFrame`
+        Time of the first and last visit, length (in days) and rows (`start` up to but not including `end`)
+        of each night, indexed by night
+    """
+    nights = df["night"].values
+    times = df[time_col].values.astype(float)
+    starts = np.flatnonzero(np.concatenate(([True], nights[1:] != nights[:-1])))[:len(df)]
+    ends = np.append(starts[1:], len(df))[:len(starts)]
+    summary = pd.DataFrame({"first_visit": times[starts], "last_visit": times[ends - 1]},
+                           index=pd.Index(nights[starts], name="night"))
+    summary["length"] = summary["last_visit"] - summary["first_visit"]
+    summary["start"] = starts
+    summary["end"] = ends
+    return summary
+
+
+def read_schedule(db_path, first_night, last_night, fields):
+    """Get the visits between two (opsim) nights, inclusive, from a schedule database. The columnar store of
+    the database (see `build_schedule_store`) is used if it exists, otherwise the database is queried.
+
+    Parameters
+    ----------
+    db_path : `str`
+        Path to the schedule database
+    first_night, last_night : `int`
+        First and last opsim night to get
+    fields : `list`
+        Columns to get
+
+    Returns
+    -------
+    df : `pandas DataFrame`
+        The visits, sorted by night (and otherwise in the order of the database). When read from a store the
+        numeric columns are read-only views of the mapped files, so copy the DataFrame before modifying them.
+    """
+    store_path = os.path.splitext(db_path)[0]
+    if os.path.exists(os.path.join(store_path, "night_offsets.npy")):
+        return pd.DataFrame(load_schedule_store(store_path).get(first_night, last_night, fields), copy=False)
+
+    # use the same order as the store so that row numbers mean the same thing whichever is read
+    con = sqlite3.connect(db_path)
+    res = con.execute(f"select {','.join(fields)} from observations where night between ? and ? "
+                      "order by night, rowid", (int(first_night), int(last_night)))
+    df = pd.DataFrame(res.fetchall(), columns=fields)
+    con.close()
+    return df
+
+
+def build_schedule_store(db_path, store_path=None):
+    """Convert a schedule database into a columnar store that can be memory-mapped. Each column is saved as
+    its own `.npy` file with the visits sorted by night (and otherwise in the order of the database) alongside
+    the row at which each night starts, so a range of nights is just a slice of each column.
+
+    Parameters
+    ----------
+    db_path : `str`
+        Path to the schedule database
+    store_path : `str`, optional
+        Folder in which to save the store, by default the database path without the `.db` (which is where
+        `get_LSST_schedule` looks for it)
+    """
+    store_path = os.path.splitext(db_path)[0] if store_path is None else store_path
+    os.makedirs(store_path, exist_ok=True)
+    if os.path.exists(os.path.join(store_path, "night_offsets.npy")):
+        os.remove(os.path.join(store_path, "night_offsets.npy"))
+
+    con = sqlite3.connect(db_path)
+    df = pd.read_sql_query("select * from observations order by night, rowid", con)
+    con.close()
+
+    # strings are stored with a fixed width so that they can be mapped too
+    for column in df.columns:
+        values = df[column].values
+        if values.dtype.kind not in "biuf":
+            values = np.asarray(values, dtype=str)
+        np.save(os.path.join(store_path, f"{column}.npy"), values)
+
+    # first row of each night (plus the end of the last one), saved last to mark the store as complete
+    nights, starts = np.unique(df["night"].values, return_index=True)
+    np.save(os.path.join(store_path, "night_values.npy"), nights)
+    np.save(os.path.join(store_path, "night_offsets.npy"), np.append(starts, len(df)))
+
+
+class ScheduleStore():
+    def __init__(self, path):
+        """A columnar schedule created by `build_schedule_store`, each column is memory-mapped when it is
+        first needed
+
+        Parameters
+        ----------
+        path : `str`
+            Folder containing the store
+        """
+        self.path = path
+        self.nights = np.load(os.path.join(path, "night_values.npy"))
+        self.offsets = np.load(os.path.join(path, "night_offsets.npy"))
+        self.columns = {}
+
+    def column(self, name):
+        """Get a (memory-mapped) column of the whole schedule"""
+        if name not in self.columns:
+            self.columns[name] = np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+        return self.columns[name]
+
+    def get(self, first_night, last_night, fields):
+        """Get the visits between two (opsim) nights, inclusive, as a dict of read-only views of each column
+
+        Parameters
+        ----------
+        first_night, last_night : `int`
+            First and last opsim night to get
+        fields : `list`
+            Columns to get
+
+        Returns
+        -------
+        columns : `dict`
+            Array of each field for the visits in those nights
+        """
+        start = self.offsets[np.searchsorted(self.nights, first_night, side="left")]
+        end = self.offsets[np.searchsorted(self.nights, last_night, side="right")]
+        return {field: self.column(field)[start:end] for field in fields}
+
+
+def load_schedule_store(path):
+    """Get the `ScheduleStore` in a folder, only opening it the first time it is requested in a process
+
+    Parameters
+    ----------
+    path : `str`
+        Folder containing the store
+
+    Returns
+    -------
+    store : `ScheduleStore`
+        The schedule store
+    """
+    # open it again if it has been rebuilt since
+    version = os.stat(os.path.join(path, "night_offsets.npy")).st_mtime_ns
+    if path not in _SCHEDULE_STORES or _SCHEDULE_STORES[path][0] != version:
+        _SCHEDULE_STORES[path] = (version, ScheduleStore(path))
+    return _SCHEDULE_STORES[path][1]
+
+
 def plot_LSST_schedule(df):
     """Plot LSST schedule up using the dataframe containing fields. Each is assumed to be a circle of radius
     2.1 degrees for simplicity.
@@ -0,0 +1,130 @@
+from multiprocessing import shared_memory
+import pickle
+import numpy as np
+import pandas as pd
+
+
+def share_dataframe(df):
+    """Copy a DataFrame into shared memory so that worker processes can attach to it without it being
+    pickled for every task. Numeric columns are stored directly, anything else (e.g. strings) is stored as
+    integer codes with the (small) list of unique values kept alongside.
+
+    Parameters
+    ----------
+    df : `pandas DataFrame`
+        Table to share
+
+    Returns
+    -------
+    handle : `dict`
+        Picklable description of the shared table to pass to `attach_dataframe`
+    blocks : `list`
+        The `SharedMemory` blocks, which should be passed to `release_shared` once the workers are done
+    """
+    handle = {"columns": [], "index": None}
+    blocks = []
+
+    def share(values):
+        if values.dtype.kind in "biuf":
+            categories = None
+        else:
+            codes, categories = pd.factorize(values)
+            values = codes
+        values = np.ascontiguousarray(values)
+        block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+        blocks.append(block)
+        return {"name": block.name, "dtype": values.dtype.str, "shape": values.shape,
+                "categories": categories}
+
+    for column in df.columns:
+        handle["columns"].append((column, share(df[column].values)))
+    handle["index"] = (df.index.name, share(df.index.values))
+    return handle, blocks
+
+
+def attach_dataframe(handle):
+    """Rebuild a DataFrame from shared memory (see `share_dataframe`) without copying the numeric data
+
+    Parameters
+    ----------
+    handle : `dict`
+        Description of the shared table from `share_dataframe`
+
+    Returns
+    -------
+    df : `pandas DataFrame`
+        The shared table (string columns and index become categoricals)
+    blocks : `list`
+        The attached `SharedMemory` blocks, these must be kept alive for as long as `df` is used
+    """
+    blocks = []
+
+    def attach(spec):
+        block = shared_memory.SharedMemory(name=spec["name"])
+        blocks.append(block)
+        values = np.ndarray(spec["shape"], dtype=np.dtype(spec["dtype"]), buffer=block.buf)
+        if spec["categories"] is not None:
+            return pd.Categorical.from_codes(values, categories=spec["categories"])
+        return values
+
+    columns = {column: attach(spec) for column, spec in handle["columns"]}
+    index_name, index_spec = handle["index"]
+    index = pd.Index(attach(index_spec), name=index_name)
+    return pd.DataFrame(columns, index=index, copy=False), blocks
+
+
+def share_object(obj):
+    """Pickle an object into shared memory once so that tasks only need to carry the name of its block
+    rather than the object itself
+
+    Parameters
+    ----------
+    obj : `any`
+        Picklable object to share
+
+    Returns
+    -------
+    name : `str`
+        Name of the block to pass to `attach_object`
+    block : `SharedMemory`
+        The block, which should be passed to `release_shared` once the workers are done
+    """
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    block = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    block.buf[:len(data)] = data
+    return block.name, block
+
+
+def attach_object(name):
+    """Read an object shared with `share_object`
+
+    Parameters
+    ----------
+    name : `str`
+        Name of the shared memory block
+
+    Returns
+    -------
+    obj : `any`
+        A copy of the shared object
+    """
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        # the block may be rounded up to a whole page, pickle ignores anything after the end of the object
+        return pickle.loads(bytes(block.buf))
+    finally:
+        block.close()
+
+
+def release_shared(blocks):
+    """Close and remove shared memory blocks created by `share_dataframe`
+
+    Parameters
+    ----------
+    blocks : `list`
+        `SharedMemory` blocks to release
+    """
+    for block in blocks:
+        block.close()
+        block.unlink()
@@ -63,3 +63,63 @@ def _filter_tracklets_applier(df, min_arc=1, max_time=90):
                              df["AstDec(deg)"].iloc[-1] * DEG_TO_RAD) / DEG_TO_RAD * DEG_TO_AS
     t = df["FieldMJD_TAI"].diff().min() * DAY_TO_MIN
     return (sep > min_arc) & (t < max_time)
+
+
+def filter_tracklet_groups(df, by, ra_col="RA_deg", dec_col="Dec_deg", time_col="mjd_utc", min_obs=2,
+                           min_arc=1, max_time=90):
+    """Keep only the groups of observations (e.g. each orbit on each night) that would make a valid tracklet,
+    i.e. at least `min_obs` observations, an arc of more than `min_arc` between the first and last and a pair
+    of consecutive observations less than `max_time` apart. Every group is checked at once using sorted
+    segments rather than applying a function to each group.
+
+    Parameters
+    ----------
+    df : `pandas DataFrame`
+        Observations to filter
+    by : `list`
+        Columns that define the groups
+    ra_col, dec_col : `str`, optional
+        Columns of the positions in degrees, by default "RA_deg" and "Dec_deg"
+    time_col : `str`, optional
+        Column of the times in days, by default "mjd_utc"
+    min_obs : `int`, optional
+        Minimum number of observations in a group, by default 2
+    min_arc : `float`, optional
+        Minimum arc length in arcseconds, by default 1
+    max_time : `float`, optional
+        Maximum time between the closest pair of observations in minutes, by default 90
+
+    Returns
+    -------
+    df : `pandas DataFrame`
+        Observations in the groups that pass, sorted by group and then time
+    """
+    if len(df) == 0:
+        return df
+
+    # sort so that each group is a contiguous segment in time order
+    keys = [df[col].values for col in by]
+    order = np.lexsort([df[time_col].values] + keys[::-1])
+    df = df.iloc[order]
+    keys = [key[order] for key in keys]
+
+    new_group = np.zeros(len(df), dtype=bool)
+    new_group[0] = True
+    for key in keys:
+        new_group[1:] |= key[1:] != key[:-1]
+    starts = np.flatnonzero(new_group)
+    ends = np.append(starts[1:], len(df)) - 1
+    counts = ends - starts + 1
+
+    # separation between the first and last observation of each group
+    ra, dec = df[ra_col].values * DEG_TO_RAD, df[dec_col].values * DEG_TO_RAD
+    sep = angular_separation(ra[starts], dec[starts], ra[ends], dec[ends]) / DEG_TO_RAD * DEG_TO_AS
+
+    # shortest gap between consecutive observations in each group (single observations have no gap)
+    times = df[time_col].values
+    gaps = np.append(np.diff(times), np.inf)
+    gaps[ends] = np.inf
+    min_gap = np.minimum.reduceat(gaps, starts) * DAY_TO_MIN
+
+    keep = (counts >= min_obs) & (sep > min_arc) & (min_gap < max_time)
+    return df[np.repeat(keep, counts)]
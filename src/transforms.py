@@ -0,0 +1,280 @@
+import astropy.units as u
+from astropy.time import Time
+from astropy.coordinates import SkyCoord, CartesianRepresentation, get_body_barycentric_posvel, get_sun
+import numpy as np
+
+# speed of light in AU/day and Schwarzschild radius of the Sun in AU
+C_AU_PER_DAY = 173.14463267424034
+SCHWARZSCHILD_RADIUS_AU = 1.97412574336e-8
+
+# agreement with astropy for solar elongations above 20 degrees (see `validate_fast_transform`)
+POSITION_TOLERANCE_AU = 1e-10
+VELOCITY_TOLERANCE_AU_PER_DAY = 1e-7
+
+_EARTH_STATE_CACHE = {}
+_EARTH_STATE_CACHE_SIZE = 100000
+
+
+def ecliptic_rotation_matrix():
+    """Rotation matrix from ICRS-aligned axes to the heliocentriceclipticiau76 axes (computed with astropy
+    once by transforming the HCRS basis vectors). The transpose rotates ecliptic vectors back to ICRS."""
+    if "matrix" not in ecliptic_rotation_matrix.__dict__:
+        basis = SkyCoord(CartesianRepresentation(np.eye(3) * u.AU), frame="hcrs", obstime=Time("J2000"))
+        ecliptic_rotation_matrix.matrix = basis.transform_to("heliocentriceclipticiau76").cartesian.xyz.value
+    return ecliptic_rotation_matrix.matrix
+
+
+def _normalise(v):
+    return v / np.linalg.norm(v, axis=-1, keepdims=True)
+
+
+def _aberrate(natural, beta, sun_distance):
+    """Apply annual aberration to natural directions (NumPy version of ERFA's ab)"""
+    bm1 = np.sqrt(1 - np.sum(beta**2, axis=-1, keepdims=True))
+    p_dot_v = np.sum(natural * beta, axis=-1, keepdims=True)
+    w1 = 1 + p_dot_v / (1 + bm1)
+    w2 = SCHWARZSCHILD_RADIUS_AU / sun_distance
+    return _normalise(natural * bm1 + w1 * beta + w2 * (beta - p_dot_v * natural))
+
+
+def _deflect(direction, sun_object, sun_observer, sun_distance):
+    """Apply gravitational light deflection by the Sun (NumPy version of ERFA's ld)"""
+    q_dot_qpe = np.sum(sun_object * (sun_object + sun_observer), axis=-1, keepdims=True)
+    w = SCHWARZSCHILD_RADIUS_AU / sun_distance / np.maximum(q_dot_qpe, 1e-6)
+    return direction + w * (sun_observer * np.sum(direction * sun_object, axis=-1, keepdims=True)
+                            - sun_object * np.sum(direction * sun_observer, axis=-1, keepdims=True))
+
+
+def _astrometric_direction(apparent, distance, beta, observer_sun):
+    """Remove aberration and light deflection from apparent directions (following astropy's aticq)"""
+    sun_distance = np.linalg.norm(observer_sun, axis=-1, keepdims=True)
+    sun_observer = observer_sun / sun_distance
+    apparent = _normalise(apparent)
+
+    # aberration, giving the natural direction
+    d = np.zeros_like(apparent)
+    for _ in range(2):
+        before = _normalise(apparent - d)
+        d = _aberrate(before, beta, sun_distance) - before
+    natural = _normalise(apparent - d)
+
+    # light deflection by the Sun (using the true Sun-object direction), giving the coordinate direction
+    d = np.zeros_like(natural)
+    for _ in range(5):
+        before = _normalise(natural - d)
+        sun_object = _normalise(observer_sun + distance[..., None] * before)
+        d = _deflect(before, sun_object, sun_observer, sun_distance) - before
+    return _normalise(natural - d)
+
+
+def earth_states(mjd):
+    """Get the barycentric position, velocity and acceleration of the Earth and the position and velocity of
+    the Sun at a series of epochs. States are cached per epoch so repeated calls (e.g. for every object
+    observed in a night) are free.
+
+    Parameters
+    ----------
+    mjd : `float/array`
+        Epochs (UTC MJD) at which to evaluate the states
+
+    Returns
+    -------
+    earth_pos, earth_vel, earth_acc, sun_pos, sun_vel : `array`
+        Barycentric ICRS states of the Earth and Sun, each with shape (N, 3) in AU, AU/day and AU/day^2
+    """
+    mjd = np.atleast_1d(mjd).astype(float)
+    unique_mjd, inverse = np.unique(mjd, return_inverse=True)
+
+    # compute any of the states that haven't been cached yet all at once
+    missing = np.array([t not in _EARTH_STATE_CACHE for t in unique_mjd])
+    if missing.any():
+        if len(_EARTH_STATE_CACHE) > _EARTH_STATE_CACHE_SIZE:
+            _EARTH_STATE_CACHE.clear()
+        times = Time(unique_mjd[missing], format="mjd")
+        earth_pos, earth_vel = get_body_barycentric_posvel("earth", times)
+        sun_pos, sun_vel = get_body_barycentric_posvel("sun", times)
+
+        # acceleration from a central difference of the velocity (this includes the pull of the Moon)
+        h = 0.01
+        _, earth_vel_after = get_body_barycentric_posvel("earth", times + h * u.day)
+        _, earth_vel_before = get_body_barycentric_posvel("earth", times - h * u.day)
+        earth_acc = (earth_vel_after - earth_vel_before) / (2 * h * u.day)
+
+        states = np.hstack((earth_pos.xyz.to(u.AU).value.T, earth_vel.xyz.to(u.AU / u.day).value.T,
+                            earth_acc.xyz.to(u.AU / u.day**2).value.T,
+                            sun_pos.xyz.to(u.AU).value.T, sun_vel.xyz.to(u.AU / u.day).value.T))
+        for t, state in zip(unique_mjd[missing], states):
+            _EARTH_STATE_CACHE[t] = state
+
+    states = np.array([_EARTH_STATE_CACHE[t] for t in unique_mjd])[inverse]
+    return states[:, 0:3], states[:, 3:6], states[:, 6:9], states[:, 9:12], states[:, 12:15]
+
+
+def observer_heliocentric_positions(obstime, obsgeoloc):
+    """Get the heliocentric ecliptic position of an observer at a series of times (NumPy version of
+    transforming a GCRS `obsgeoloc` to heliocentriceclipticiau76)
+
+    Parameters
+    ----------
+    obstime : `Astropy Time object`
+        Times of the observations
+    obsgeoloc : `Astropy Quantity`
+        Geocentric position of the observer (3 vector with units)
+
+    Returns
+    -------
+    positions : `array`
+        Heliocentric ecliptic positions in AU with shape (N, 3)
+    """
+    earth_pos, _, _, sun_pos, _ = earth_states(np.atleast_1d(obstime.mjd))
+    observer = earth_pos + obsgeoloc.to(u.AU).value - sun_pos
+    return observer @ ecliptic_rotation_matrix().T
+
+
+def observer_heliocentric_states(times, location):
+    """Get the heliocentric ecliptic position and velocity of an observatory at a series of times (including
+    the rotation of the Earth)
+
+    Parameters
+    ----------
+    times : `Astropy Time object`
+        Times at which to get the states
+    location : `Astropy EarthLocation`
+        Location of the observatory
+
+    Returns
+    -------
+    states : `array`
+        Heliocentric ecliptic cartesian states with shape (N, 6) in AU and AU/day
+    """
+    times = Time(np.atleast_1d(times))
+    earth_pos, earth_vel, _, sun_pos, sun_vel = earth_states(times.mjd)
+    obs_pos, obs_vel = location.get_gcrs_posvel(times)
+    position = earth_pos + obs_pos.xyz.to(u.AU).value.T - sun_pos
+    velocity = earth_vel + obs_vel.xyz.to(u.AU / u.day).value.T - sun_vel
+
+    rotation = ecliptic_rotation_matrix()
+    return np.hstack((position @ rotation.T, velocity @ rotation.T))
+
+
+def gcrs_to_heliocentric_ecliptic(ra, dec, pm_ra_cosdec, pm_dec, distance, radial_velocity, obstime,
+                                  obsgeoloc):
+    """Convert (topocentric) GCRS coordinates into heliocentric ecliptic (IAU76, J2000) cartesian states
+    using only NumPy. This is a fast path for
+    ``SkyCoord(..., frame="gcrs", obsgeoloc=obsgeoloc).transform_to("heliocentriceclipticiau76")``.
+
+    Annual aberration and gravitational light deflection by the Sun are removed in the same way as astropy's
+    `aticq`. Velocities use a central difference that includes the change in aberration over time, as
+    astropy does. For solar elongations above 20 degrees the agreement with astropy is better than
+    `POSITION_TOLERANCE_AU` and `VELOCITY_TOLERANCE_AU_PER_DAY` (see `validate_fast_transform`).
+
+    Parameters
+    ----------
+    ra, dec : `float/array`
+        Apparent right ascension and declination (with Astropy units)
+    pm_ra_cosdec, pm_dec : `float/array`
+        Proper motions (with Astropy units)
+    distance : `float/array`
+        Distance from the observer (with Astropy units)
+    radial_velocity : `float/array`
+        Radial velocity relative to the observer (with Astropy units)
+    obstime : `Astropy Time object`
+        Time of each observation
+    obsgeoloc : `Astropy Quantity`
+        Geocentric position of the observer (3 vector with units)
+
+    Returns
+    -------
+    orbits : `array`
+        Heliocentric ecliptic cartesian states with shape (N, 6) in AU and AU/day
+    """
+    ra, dec = ra.to(u.rad).value, dec.to(u.rad).value
+    pm_ra_cosdec = pm_ra_cosdec.to(u.rad / u.day).value
+    pm_dec = pm_dec.to(u.rad / u.day).value
+    distance = distance.to(u.AU).value
+    radial_velocity = radial_velocity.to(u.AU / u.day).value
+    ra, dec, pm_ra_cosdec, pm_dec, distance, radial_velocity = np.broadcast_arrays(
+        ra, dec, pm_ra_cosdec, pm_dec, distance, radial_velocity)
+
+    earth_pos, earth_vel, earth_acc, sun_pos, sun_vel = earth_states(np.broadcast_to(obstime.mjd, ra.shape))
+
+    # unit vectors towards the object and its (angular) velocity on the sky
+    cos_ra, sin_ra, cos_dec, sin_dec = np.cos(ra), np.sin(ra), np.cos(dec), np.sin(dec)
+    p = np.stack((cos_dec * cos_ra, cos_dec * sin_ra, sin_dec), axis=-1)
+    e_ra = np.stack((-sin_ra, cos_ra, np.zeros_like(ra)), axis=-1)
+    e_dec = np.stack((-sin_dec * cos_ra, -sin_dec * sin_ra, cos_dec), axis=-1)
+    angular_velocity = e_ra * pm_ra_cosdec[..., None] + e_dec * pm_dec[..., None]
+
+    # observer velocity (in units of c), its rate of change and the observer-Sun vector
+    observer_sun = earth_pos + obsgeoloc.to(u.AU).value - sun_pos
+    beta = earth_vel / C_AU_PER_DAY
+    beta_dot = earth_acc / C_AU_PER_DAY
+
+    # remove aberration and light deflection from the apparent direction and (using a central difference,
+    # like astropy) from its rate of change
+    astrometric = _astrometric_direction(p, distance, beta, observer_sun)
+    dt = 1e-4
+    after = _astrometric_direction(p + angular_velocity * dt, distance, beta + beta_dot * dt, observer_sun)
+    before = _astrometric_direction(p - angular_velocity * dt, distance, beta - beta_dot * dt, observer_sun)
+    direction_rate = (after - before) / (2 * dt)
+
+    # position relative to the observer then shifted to the Sun
+    position = astrometric * distance[..., None] + observer_sun
+
+    # velocity relative to the observer plus the motion of the Earth around the Sun
+    velocity = (astrometric * radial_velocity[..., None] + direction_rate * distance[..., None]
+                + earth_vel - sun_vel)
+
+    rotation = ecliptic_rotation_matrix()
+    return np.concatenate((position @ rotation.T, velocity @ rotation.T), axis=-1)
+
+
+def validate_fast_transform(n_points=1000, seed=None, min_elongation=20 * u.deg):
+    """Compare `gcrs_to_heliocentric_ecliptic` to astropy for random coordinates over the LSST survey
+
+    Parameters
+    ----------
+    n_points : `int`, optional
+        How many random points to compare, by default 1000
+    seed : `int`, optional
+        Random seed, by default None
+    min_elongation : `float`, optional
+        Ignore any points closer than this to the Sun (with Astropy units), by default 20 degrees
+
+    Returns
+    -------
+    max_pos_diff : `float`
+        Largest difference in position (AU)
+    max_vel_diff : `float`
+        Largest difference in velocity (AU/day)
+    """
+    rng = np.random.default_rng(seed)
+    ra = rng.uniform(0, 360, n_points) * u.deg
+    dec = np.rad2deg(np.arcsin(rng.uniform(-1, 1, n_points))) * u.deg
+    pm_ra_cosdec = rng.uniform(-5, 5, n_points) * u.deg / u.day
+    pm_dec = rng.uniform(-5, 5, n_points) * u.deg / u.day
+    distance = 10**rng.uniform(-1, 1, n_points) * u.AU
+    radial_velocity = rng.uniform(-50, 10, n_points) * u.km / u.s
+    obstime = Time(rng.uniform(60796, 60796 + 3650, n_points), format="mjd")
+    obsgeoloc = [1820193.06844603, -5208343.03427567, -3194842.50048343] * u.m
+
+    ecl = SkyCoord(ra=ra, dec=dec, pm_ra_cosdec=pm_ra_cosdec, pm_dec=pm_dec, distance=distance,
+                   radial_velocity=radial_velocity, frame="gcrs", obsgeoloc=obsgeoloc,
+                   obstime=obstime).transform_to("heliocentriceclipticiau76")
+    truth = np.concatenate((ecl.cartesian.xyz.to(u.AU).value,
+                            ecl.velocity.d_xyz.to(u.AU / u.day).value)).T
+
+    fast = gcrs_to_heliocentric_ecliptic(ra=ra, dec=dec, pm_ra_cosdec=pm_ra_cosdec, pm_dec=pm_dec,
+                                         distance=distance, radial_velocity=radial_velocity, obstime=obstime,
+                                         obsgeoloc=obsgeoloc)
+
+    # LSST never observes this close to the Sun and the finite differences are unstable there
+    far_from_sun = SkyCoord(ra=ra, dec=dec, frame="gcrs", obstime=obstime).separation(get_sun(obstime))\
+        > min_elongation
+
+    max_pos_diff = np.linalg.norm(fast[:, :3] - truth[:, :3], axis=1)[far_from_sun].max()
+    max_vel_diff = np.linalg.norm(fast[:, 3:] - truth[:, 3:], axis=1)[far_from_sun].max()
+    if max_pos_diff > POSITION_TOLERANCE_AU or max_vel_diff > VELOCITY_TOLERANCE_AU_PER_DAY:
+        print(f"Warning: fast transform disagrees with astropy by {max_pos_diff:1.2e} AU and "
+              f"{max_vel_diff:1.2e} AU/day")
+    return max_pos_diff, max_vel_diff
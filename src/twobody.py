@@ -0,0 +1,325 @@
+from astropy.coordinates import angular_separation
+import numpy as np
+import pandas as pd
+
+from magnitudes import apparent_magnitude
+from transforms import ecliptic_rotation_matrix
+
+# solar gravitational parameter in AU^3/day^2 and speed of light in AU/day (matching THOR's constants)
+MU = 0.29591220828559115e-3
+C_AU_PER_DAY = 173.14463267424034
+
+
+def stumpff(z):
+    """Stumpff functions C(z) and S(z) for an array of z (using a series expansion close to zero)
+
+    Parameters
+    ----------
+    z : `array`
+        Values at which to evaluate the functions
+
+    Returns
+    -------
+    c, s : `array`
+        Values of C(z) and S(z)
+    """
+    z = np.asarray(z, dtype=float)
+    c, s = np.zeros_like(z), np.zeros_like(z)
+
+    pos, neg = z > 1e-6, z < -1e-6
+    small = ~(pos | neg)
+
+    sqrt_z = np.sqrt(z[pos])
+    c[pos] = (1 - np.cos(sqrt_z)) / z[pos]
+    s[pos] = (sqrt_z - np.sin(sqrt_z)) / sqrt_z**3
+
+    # cap the argument to avoid overflows for very hyperbolic orbits
+    sqrt_mz = np.minimum(np.sqrt(-z[neg]), 700)
+    c[neg] = (np.cosh(sqrt_mz) - 1) / sqrt_mz**2
+    s[neg] = (np.sinh(sqrt_mz) - sqrt_mz) / sqrt_mz**3
+
+    zs = z[small]
+    c[small] = 1 / 2 - zs / 24 + zs**2 / 720
+    s[small] = 1 / 6 - zs / 120 + zs**2 / 5040
+    return c, s
+
+
+def propagate_universal(orbits, dt, mu=MU, max_iter=100, tol=1e-14):
+    """Propagate cartesian states by a time `dt` with a vectorised universal variable Kepler solver. Every
+    orbit is solved at the same time and each one stops iterating as soon as it has converged.
+
+    Parameters
+    ----------
+    orbits : `array`
+        Cartesian states (x, y, z, vx, vy, vz) in AU and AU/day with shape (N, 6)
+    dt : `float/array`
+        Time to propagate each orbit by in days (positive or negative)
+    mu : `float`, optional
+        Gravitational parameter in AU^3/day^2, by default the Sun's
+    max_iter : `int`, optional
+        Maximum number of Newton iterations, by default 100
+    tol : `float`, optional
+        Convergence tolerance on the universal anomaly, by default 1e-14
+
+    Returns
+    -------
+    propagated : `array`
+        Propagated cartesian states with shape (N, 6)
+    converged : `array`
+        Boolean mask of which orbits converged
+    """
+    orbits = np.atleast_2d(orbits)
+    r0, v0 = orbits[:, :3], orbits[:, 3:]
+    dt = np.broadcast_to(dt, len(orbits)).astype(float)
+
+    r0_mag = np.linalg.norm(r0, axis=1)
+    sqrt_mu = np.sqrt(mu)
+    alpha = 2 / r0_mag - np.sum(v0**2, axis=1) / mu
+    sigma0 = np.sum(r0 * v0, axis=1) / sqrt_mu
+
+    # initial guess for the universal anomaly (exact for circular orbits, first order for the rest)
+    chi = np.where(alpha > 0, sqrt_mu * alpha * dt, sqrt_mu * dt / r0_mag)
+
+    # only iterate on the orbits that haven't converged yet
+    active = np.isfinite(chi)
+    chi[~active] = 0.0
+    converged = np.zeros(len(orbits), dtype=bool)
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        x = chi[active]
+        z = alpha[active] * x**2
+        c, s = stumpff(z)
+        f = sigma0[active] * x**2 * c + (1 - alpha[active] * r0_mag[active]) * x**3 * s\
+            + r0_mag[active] * x - sqrt_mu * dt[active]
+        df = sigma0[active] * x * (1 - z * s) + (1 - alpha[active] * r0_mag[active]) * x**2 * c\
+            + r0_mag[active]
+        step = f / df
+        chi[active] = x - step
+
+        done = np.abs(step) <= tol * np.maximum(1, np.abs(x))
+        indices = np.flatnonzero(active)
+        converged[indices[done]] = True
+        active[indices[done | ~np.isfinite(step)]] = False
+
+    # lagrange coefficients
+    z = alpha * chi**2
+    c, s = stumpff(z)
+    f = 1 - chi**2 / r0_mag * c
+    g = dt - chi**3 * s / sqrt_mu
+    r = f[:, None] * r0 + g[:, None] * v0
+    r_mag = np.linalg.norm(r, axis=1)
+    f_dot = sqrt_mu / (r_mag * r0_mag) * (alpha * chi**3 * s - chi)
+    g_dot = 1 - chi**2 / r_mag * c
+    v = f_dot[:, None] * r0 + g_dot[:, None] * v0
+
+    propagated = np.hstack((r, v))
+    converged &= np.isfinite(propagated).all(axis=1)
+    return propagated, converged
+
+
+def perihelion_distance(orbits, mu=MU):
+    """Calculate the perihelion distance of a set of cartesian states directly (without converting to
+    keplerian elements). This is conserved in the two-body problem so can be computed before any light-time
+    correction or propagation.
+
+    Parameters
+    ----------
+    orbits : `array`
+        Cartesian states (x, y, z, vx, vy, vz) in AU and AU/day with shape (N, 6)
+    mu : `float`, optional
+        Gravitational parameter in AU^3/day^2, by default the Sun's
+
+    Returns
+    -------
+    q : `array`
+        Perihelion distance of each orbit in AU
+    """
+    orbits = np.atleast_2d(orbits)
+    r, v = orbits[:, :3], orbits[:, 3:]
+    h = np.cross(r, v)
+
+    # eccentricity vector and semi-latus rectum give q = p / (1 + e) for any conic
+    e = np.linalg.norm(np.cross(v, h) / mu - r / np.linalg.norm(r, axis=1)[:, None], axis=1)
+    p = np.sum(h**2, axis=1) / mu
+    return p / (1 + e)
+
+
+def add_light_time(orbits, t0, observer_positions, lt_tol=1e-10, mu=MU, max_iter=1000, tol=1e-15):
+    """Correct orbits for light travel time to an observer. This is a vectorised version of
+    `thor.addLightTime`: every orbit is iterated together and each stops as soon as its light time
+    has converged. Rather than returning NaNs, orbits that fail to converge are flagged.
+
+    Parameters
+    ----------
+    orbits : `array`
+        Cartesian states (x, y, z, vx, vy, vz) in AU and AU/day with shape (N, 6)
+    t0 : `float/array`
+        Epoch of each orbit in MJD (unused, kept to match the signature of `thor.addLightTime`)
+    observer_positions : `array`
+        Position of the observer at `t0` in AU with shape (N, 3)
+    lt_tol : `float`, optional
+        Convergence tolerance on the light time in days, by default 1e-10
+    mu : `float`, optional
+        Gravitational parameter in AU^3/day^2, by default the Sun's
+    max_iter : `int`, optional
+        Maximum number of light time iterations, by default 1000
+    tol : `float`, optional
+        Tolerance passed to the Kepler solver, by default 1e-15
+
+    Returns
+    -------
+    corrected_orbits : `array`
+        States at the time the light was emitted (t0 - lt) with shape (N, 6)
+    lt : `array`
+        Light travel time for each orbit in days
+    converged : `array`
+        Boolean mask of which orbits converged
+    """
+    orbits = np.atleast_2d(orbits)
+    observer_positions = np.atleast_2d(observer_positions)
+
+    corrected_orbits = orbits.copy()
+    lt = np.linalg.norm(orbits[:, :3] - observer_positions, axis=1) / C_AU_PER_DAY
+    converged = np.zeros(len(orbits), dtype=bool)
+    active = np.ones(len(orbits), dtype=bool)
+
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        indices = np.flatnonzero(active)
+
+        # propagate back to the emission time and work out the new light time
+        propagated, ok = propagate_universal(orbits[indices], -lt[indices], mu=mu, tol=tol)
+        corrected_orbits[indices] = propagated
+        new_lt = np.linalg.norm(propagated[:, :3] - observer_positions[indices], axis=1) / C_AU_PER_DAY
+
+        done = np.abs(new_lt - lt[indices]) < lt_tol
+        lt[indices] = new_lt
+        converged[indices[done & ok]] = True
+        active[indices[done | ~ok]] = False
+
+    return corrected_orbits, lt, converged
+
+
+def generate_ephemeris(orbits, epochs, eph_times, observer_states, H=None, G=0.15, ids=None, obs_code="I11"):
+    """Generate ephemerides for a set of heliocentric ecliptic orbits with a two-body propagator. Every
+    (orbit, time) pair is propagated and light-time corrected at once. This ignores planetary
+    perturbations so is only appropriate for short windows (e.g. a 15 night detection window).
+
+    Parameters
+    ----------
+    orbits : `array`
+        Heliocentric ecliptic cartesian states in AU and AU/day with shape (N, 6)
+    epochs : `array`
+        Epoch of each orbit in MJD
+    eph_times : `array`
+        Times at which to produce ephemerides in MJD (same time scale as `epochs`)
+    observer_states : `array`
+        Heliocentric ecliptic state of the observer at each of `eph_times` with shape (M, 6)
+    H : `array`, optional
+        Absolute magnitude of each orbit, by default None (no magnitudes are calculated)
+    G : `float/array`, optional
+        Slope parameter, by default 0.15
+    ids : `array`, optional
+        ID of each orbit, by default their index
+    obs_code : `str`, optional
+        Observatory code to put in the table, by default "I11"
+
+    Returns
+    -------
+    df : `pandas DataFrame`
+        Ephemerides with the same columns that the mitigation code reads from pyoorb (`orbit_id`, `mjd_utc`,
+        `RA_deg`, `Dec_deg`, `vRAcosDec`, `vDec`, `r_au`, `delta_au`, `PhaseAngle_deg`, `VMag`) as well as
+        `time_index`, the index of each row's time in `eph_times`
+    """
+    orbits = np.atleast_2d(orbits)
+    eph_times = np.atleast_1d(eph_times)
+    n_orbits, n_times = len(orbits), len(eph_times)
+    if ids is None:
+        ids = np.arange(n_orbits)
+
+    # every (orbit, time) pair
+    orbit_index = np.repeat(np.arange(n_orbits), n_times)
+    time_index = np.tile(np.arange(n_times), n_orbits)
+    observer = observer_states[time_index]
+
+    # propagate to each time and then back by the light travel time
+    propagated, converged = propagate_universal(orbits[orbit_index],
+                                                eph_times[time_index] - epochs[orbit_index])
+    emitted, _, lt_converged = add_light_time(propagated, eph_times[time_index], observer[:, :3])
+    converged &= lt_converged
+
+    # topocentric position and velocity rotated back to equatorial coordinates
+    rotation = ecliptic_rotation_matrix()
+    rho = (emitted[:, :3] - observer[:, :3]) @ rotation
+    rho_dot = (emitted[:, 3:] - observer[:, 3:]) @ rotation
+    delta = np.linalg.norm(rho, axis=1)
+    r = np.linalg.norm(emitted[:, :3], axis=1)
+
+    ra = np.arctan2(rho[:, 1], rho[:, 0]) % (2 * np.pi)
+    dec = np.arcsin(rho[:, 2] / delta)
+    cos_ra, sin_ra, cos_dec, sin_dec = np.cos(ra), np.sin(ra), np.cos(dec), np.sin(dec)
+    v_ra_cos_dec = (-sin_ra * rho_dot[:, 0] + cos_ra * rho_dot[:, 1]) / delta
+    v_dec = (-sin_dec * cos_ra * rho_dot[:, 0] - sin_dec * sin_ra * rho_dot[:, 1]
+             + cos_dec * rho_dot[:, 2]) / delta
+
+    # angle between the directions to the Sun and to the observer as seen from the object
+    phase_angle = np.arccos(np.clip(np.sum(emitted[:, :3] * (emitted[:, :3] - observer[:, :3]), axis=1)
+                                    / (r * delta), -1, 1))
+
+    df = pd.DataFrame({"orbit_id": np.asarray(ids)[orbit_index],
+                       "observatory_code": obs_code,
+                       "mjd_utc": eph_times[time_index],
+                       "time_index": time_index,
+                       "RA_deg": np.rad2deg(ra),
+                       "Dec_deg": np.rad2deg(dec),
+                       "vRAcosDec": np.rad2deg(v_ra_cos_dec),
+                       "vDec": np.rad2deg(v_dec),
+                       "r_au": r,
+                       "delta_au": delta,
+                       "PhaseAngle_deg": np.rad2deg(phase_angle),
+                       "VMag": np.nan})
+    if H is not None:
+        df["VMag"] = apparent_magnitude(H=np.asarray(H)[orbit_index], d_ast_sun=r, d_ast_earth=delta,
+                                        phase_angle=phase_angle, G=G)
+    return df[converged].reset_index(drop=True)
+
+
+def compare_ephemerides(ephemerides, reference):
+    """Compare two ephemeris tables (e.g. `generate_ephemeris` against pyoorb) for the same orbits and times
+
+    Parameters
+    ----------
+    ephemerides : `pandas DataFrame`
+        Ephemerides to check
+    reference : `pandas DataFrame`
+        Reference ephemerides, both tables need a `time_index` column (the index of each row's time, as
+        from `generate_ephemeris`) so that rows are matched without comparing floats
+
+    Returns
+    -------
+    deviations : `dict`
+        Maximum absolute deviation in sky position (arcsec), rates (deg/day), distance (AU) and
+        magnitude over every matching (orbit_id, time_index) row, as well as how many rows were compared
+    """
+    keys = ["orbit_id", "time_index"]
+    ephemerides, reference = ephemerides.copy(), reference.copy()
+    for df in [ephemerides, reference]:
+        df["orbit_id"] = df["orbit_id"].astype(str)
+        df["time_index"] = df["time_index"].astype(int)
+    merged = pd.merge(ephemerides, reference, on=keys, suffixes=("", "_ref"))
+
+    ra, dec = np.deg2rad(merged["RA_deg"].values), np.deg2rad(merged["Dec_deg"].values)
+    ra_ref, dec_ref = np.deg2rad(merged["RA_deg_ref"].values), np.deg2rad(merged["Dec_deg_ref"].values)
+    sep = angular_separation(ra, dec, ra_ref, dec_ref)
+
+    def max_diff(col):
+        return np.nanmax(np.abs(merged[col].values - merged[col + "_ref"].values), initial=0.0)
+
+    return {"n_compared": len(merged),
+            "sky_arcsec": np.rad2deg(np.max(sep, initial=0.0)) * 3600,
+            "vRAcosDec": max_diff("vRAcosDec"),
+            "vDec": max_diff("vDec"),
+            "delta_au": max_diff("delta_au"),
+            "VMag": max_diff("VMag")}
@@ -11,6 +11,9 @@ import pandas as pd
 pd.set_option("display.max_columns", None)
 
 from magnitudes import absolute_magnitude
+from transforms import (gcrs_to_heliocentric_ecliptic, observer_heliocentric_positions,
+                        observer_heliocentric_states)
+from twobody import perihelion_distance, add_light_time, generate_ephemeris, compare_ephemerides
 
 import thor
 from thor.constants import Constants
@@ -19,6 +22,7 @@ backend = PYOORB()
 
 import urllib.request
 import json
+import warnings
 
 plt.rc('font', family='serif')
 plt.rcParams['text.usetex'] = False
@@ -38,10 +42,450 @@ params = {'figure.figsize': (12, 8),
 plt.rcParams.update(params)
 
 
+def _observer_location(location):
+    """Get the EarthLocation of an observatory (avoiding the internet for Gemini South)"""
+    if location == "Gemini South":
+        # avoid using the internet for hyak if it is just Gemini South
+        return EarthLocation(1820193.06844603, -5208343.03427567, -3194842.50048343, unit="m")
+    return EarthLocation.of_site(location)
+
+
+def scatter_seed(rng):
+    """Get a seed for the astrometric scatter that gives the same numbers every time it is used. A numpy
+    Generator is drawn from once to make a new seed (so pass the result on rather than the generator if the
+    same scatter is needed for several subsets of a grid), anything else is already a seed.
+
+    Parameters
+    ----------
+    rng : `numpy Generator/SeedSequence/int`
+        Random number generator or seed
+
+    Returns
+    -------
+    seed : `numpy SeedSequence/int`
+        Seed for the scatter
+    """
+    if isinstance(rng, np.random.Generator):
+        return np.random.SeedSequence(int(rng.integers(2**63)))
+    return rng
+
+
+def variant_orbit_states(ra, dec, ra_end, dec_end, delta_t, obstime, distances, radial_velocities,
+                         sigma_ra=0.1 * u.arcsecond, sigma_dec=0.1 * u.arcsecond, apparent_mag=None,
+                         coords="heliocentriceclipticiau76", location="Gemini South",
+                         pm_ra_cosdec=None, pm_dec=None, only_neos=False, transform="astropy",
+                         light_time="thor", observatory=None, grid_points=None, rng=None, verbose=False):
+    """Generate light-time corrected cartesian states for a grid of variant orbits for a batch of
+    tracklets at once. All of the setup (observer positions, SkyCoord creation, frame transforms and
+    light-time correction) is done once for every orbit of every tracklet.
+
+    Parameters
+    ----------
+    ra : `float/array`
+        Right ascension at initial observation of each tracklet (with Astropy units)
+    dec : `float/array`
+        Declination at initial observation of each tracklet (with Astropy units)
+    ra_end : `float/array`
+        Right ascension at final observation of each tracklet (with Astropy units)
+    dec_end : `float/array`
+        Declination at final observation of each tracklet (with Astropy units)
+    delta_t : `float/array`
+        Time between observations of each tracklet (with Astropy units)
+    obstime : `Astropy Time object`
+        Time of initial observation of each tracklet
+    distances : `float/array`
+        Array of possible distances to use
+    radial_velocities : `float/array`
+        Array of possible radial velocities to use
+    apparent_mag : `float/array`, optional
+        Apparent magnitude of each tracklet in V band
+    pm_ra_cosdec, pm_dec : `float/array`, optional
+        Directly calculated proper motions of each tracklet (replaces ra_end, dec_end, delta_t)
+    transform : `str`, optional
+        Which engine to use for the GCRS to ecliptic transform, either "astropy" or "numpy" (a vectorised fast
+        path for "heliocentriceclipticiau76" only, see `transforms.gcrs_to_heliocentric_ecliptic`), by
+        default "astropy"
+    light_time : `str`, optional
+        Which light-time solver to use, either "thor" (`thor.addLightTime`, orbits that fail get no
+        correction) or "numpy" (`twobody.add_light_time`, orbits that fail are removed with a warning), by
+        default "thor"
+    observatory : `ObservatoryEphemeris`, optional
+        Precomputed observatory table used for the observer positions and the observer-Sun distance instead
+        of computing them for every call, by default None
+    grid_points : `array`, optional
+        Indices of the points in the flattened distance-radial velocity grid to use (these become the
+        `orbit_id`), by default every point
+    rng : `numpy Generator/SeedSequence/int`, optional
+        Seed (or generator to draw one from, see `scatter_seed`) for the astrometric scatter. The scatter is
+        drawn for the whole grid and then picked out for `grid_points`, so each orbit gets the same scatter
+        whichever subset of the grid it is generated with. By default None (the global `np.random` state)
+
+    See `variant_orbit_ephemerides` for the remaining parameters.
+
+    Returns
+    -------
+    states : `dict`
+        Dictionary with the "orbits" (cartesian states in AU and AU/day), "epochs" (light-time corrected
+        MJDs), "H" (absolute magnitudes, or None), "tracklet_id" (index of the tracklet for each orbit)
+        and "orbit_id" (index of each orbit in the flattened distance-radial velocity grid), plus
+        "n_culled" (how many grid points were removed by `only_neos`)
+    """
+    # make sure everything is an array with one item per tracklet
+    ra, dec = np.atleast_1d(ra), np.atleast_1d(dec)
+    obstime = Time(np.atleast_1d(obstime))
+    n_tracklets = len(ra)
+
+    # create a grid from the distances and radial velocities
+    D, RV = np.meshgrid(distances, radial_velocities)
+    grid_points = np.arange(D.size) if grid_points is None else np.atleast_1d(grid_points)
+    size = len(grid_points)
+    tracklet_id = np.repeat(np.arange(n_tracklets), size)
+    orbit_id = np.tile(grid_points, n_tracklets)
+    total = n_tracklets * size
+
+    # need a list with units rather than list of things each with units
+    obs_loc = _observer_location(location)
+    obsgeoloc = [x.to(u.m).value for x in obs_loc.geocentric] * u.m
+
+    if transform not in ["numpy", "astropy"]:
+        raise ValueError(f"Invalid value for `transform`: {transform}")
+    if transform == "numpy" and coords != "heliocentriceclipticiau76":
+        raise ValueError("The numpy transform only supports `coords='heliocentriceclipticiau76'`")
+
+    # get the observer position in cartesian GCRS coordinates for THOR (once per tracklet), either from
+    # the precomputed observatory table or by transforming the observatory location directly
+    if observatory is not None:
+        observer_positions = observatory.positions(obstime.utc.mjd)[tracklet_id]
+    elif transform == "numpy":
+        observer_positions = observer_heliocentric_positions(obstime, obsgeoloc)[tracklet_id]
+    elif transform == "astropy":
+        observer_position = SkyCoord(x=np.repeat(obsgeoloc[0], n_tracklets),
+                                     y=np.repeat(obsgeoloc[1], n_tracklets),
+                                     z=np.repeat(obsgeoloc[2], n_tracklets),
+                                     obstime=obstime,
+                                     frame="gcrs",
+                                     representation_type="cartesian").transform_to(coords).cartesian.xyz
+        observer_positions = observer_position.to(u.AU).value.T[tracklet_id]
+
+    # if proper motions are not provided
+    if pm_ra_cosdec is None and pm_dec is None:
+        ra_end, dec_end = np.atleast_1d(ra_end), np.atleast_1d(dec_end)
+        delta_t = np.repeat(np.atleast_1d(delta_t) * np.ones(n_tracklets), size)
+
+        # add some dispersion to the ra/dec's with the given sigmas (or just repeat if not are given)
+        ra = np.repeat(ra.value, repeats=size) * ra.unit
+        ra_end = np.repeat(ra_end.value, repeats=size) * ra_end.unit
+        dec = np.repeat(dec.value, repeats=size) * dec.unit
+        dec_end = np.repeat(dec_end.value, repeats=size) * dec_end.unit
+        if rng is None:
+            if sigma_ra.value != 0.0:
+                # TODO: check with Mario about adding scatter near poles
+                ra = np.random.normal(ra.value, scale=sigma_ra.to(ra.unit).value, size=total) * ra.unit
+                ra_end = np.random.normal(ra_end.value, scale=sigma_ra.to(ra_end.unit).value,
+                                          size=total) * ra_end.unit
+            if sigma_dec.value != 0.0:
+                dec = np.random.normal(dec.value, scale=sigma_dec.to(dec.unit).value, size=total) * dec.unit
+                dec_end = np.random.normal(dec_end.value, scale=sigma_dec.to(dec_end.unit).value,
+                                           size=total) * dec_end.unit
+        else:
+            # draw the scatter of every point in the full grid and keep the ones being used, so that an
+            # orbit's scatter depends only on its orbit_id (not on chunking or sampling)
+            scatter = np.random.default_rng(scatter_seed(rng)).standard_normal((4, n_tracklets, D.size))
+            scatter = scatter[:, :, grid_points].reshape(4, total)
+            ra = ra + scatter[0] * sigma_ra
+            ra_end = ra_end + scatter[1] * sigma_ra
+            dec = dec + scatter[2] * sigma_dec
+            dec_end = dec_end + scatter[3] * sigma_dec
+
+        # convert them to Skycoords
+        start = SkyCoord(ra=ra, dec=dec, frame="icrs")
+        end = SkyCoord(ra=ra_end, dec=dec_end, frame="icrs")
+
+        # calculate the offset in ra/dec and convert to a proper motion
+        delta_ra_cosdec, delta_dec = start.spherical_offsets_to(end)
+        pm_ra_cosdec, pm_dec = delta_ra_cosdec / delta_t, delta_dec / delta_t
+
+        if verbose:
+            print(ra, dec, ra_end, dec_end, delta_t, pm_ra_cosdec, pm_dec)
+    else:
+        ra = np.repeat(ra.value, repeats=size) * ra.unit
+        dec = np.repeat(dec.value, repeats=size) * dec.unit
+        pm_ra_cosdec = np.repeat(np.atleast_1d(pm_ra_cosdec) * np.ones(n_tracklets), size)
+        pm_dec = np.repeat(np.atleast_1d(pm_dec) * np.ones(n_tracklets), size)
+
+    distance = np.tile(D.ravel()[grid_points], n_tracklets)
+    radial_velocity = np.tile(RV.ravel()[grid_points], n_tracklets)
+    t0 = obstime[tracklet_id].mjd
+
+    if transform == "numpy":
+        # convert straight to heliocentric ecliptic states with NumPy
+        orbits = gcrs_to_heliocentric_ecliptic(ra=ra, dec=dec, pm_ra_cosdec=pm_ra_cosdec, pm_dec=pm_dec,
+                                               distance=distance, radial_velocity=radial_velocity,
+                                               obstime=obstime[tracklet_id], obsgeoloc=obsgeoloc)
+    else:
+        # put it all together into a single astropy SkyCoord in GCRS (using loc/time from above)
+        coord = SkyCoord(ra=ra,
+                         dec=dec,
+                         pm_ra_cosdec=pm_ra_cosdec,
+                         pm_dec=pm_dec,
+                         distance=distance,
+                         radial_velocity=radial_velocity,
+                         frame="gcrs",
+                         obsgeoloc=obsgeoloc,
+                         obstime=obstime[tracklet_id])
+
+        # convert to ecliptic
+        ecl = coord.transform_to(coords)
+
+        # translate astropy into what THOR wants
+        orbits = np.atleast_2d(np.concatenate((ecl.cartesian.xyz.to(u.AU).value,
+                                               ecl.velocity.d_xyz.to(u.AU / u.day).value))).T
+
+    # cull anything with a perihelion above 1.3 AU if you only want NEO orbits, q is conserved so this can be
+    # done straight from the states before paying for the light-time correction
+    n_culled = 0
+    if only_neos:
+        neo = perihelion_distance(orbits, mu=Constants.MU) < 1.3
+        n_culled = int((~neo).sum())
+        orbits, t0, observer_positions = orbits[neo], t0[neo], observer_positions[neo]
+        tracklet_id, orbit_id, distance = tracklet_id[neo], orbit_id[neo], distance[neo]
+        if verbose:
+            print(f"Culled {n_culled} of {total} variant orbits with q >= 1.3 AU")
+
+    # account for light travel time
+    if light_time == "thor":
+        corrected_orbits, lt = thor.addLightTime(orbits=orbits, t0=t0, observer_positions=observer_positions,
+                                                 lt_tol=1e-10, mu=Constants.MU, max_iter=1000, tol=1e-15)
+        lt = np.nan_to_num(lt, nan=0.0)
+        converged = np.repeat(True, len(orbits))
+    elif light_time == "numpy":
+        corrected_orbits, lt, converged = add_light_time(orbits=orbits, t0=t0,
+                                                         observer_positions=observer_positions, lt_tol=1e-10,
+                                                         mu=Constants.MU, max_iter=1000, tol=1e-15)
+        if not converged.all():
+            warnings.warn(f"Light time correction did not converge for {(~converged).sum()} of "
+                          f"{len(orbits)} orbits (orbit ids {orbit_id[~converged]}), these orbits have been "
+                          "removed")
+    else:
+        raise ValueError(f"Invalid value for `light_time`: {light_time}")
+    corrected_t0 = t0 - lt
+
+    if apparent_mag is None:
+        H = None
+    else:
+        d_ast_sun = np.linalg.norm(orbits[:, :3], axis=1)
+        d_ast_earth = distance.to(u.AU).value
+        # the table gives the observer-Sun distance, which is consistent with the topocentric d_ast_earth
+        if observatory is not None:
+            d_earth_sun = observatory.sun_distances(corrected_t0)
+        else:
+            d_earth_sun = get_sun(time=Time(corrected_t0, format="mjd")).distance.to(u.AU).value
+        H = absolute_magnitude(m=np.atleast_1d(apparent_mag)[tracklet_id],
+                               d_ast_sun=d_ast_sun, d_ast_earth=d_ast_earth, d_earth_sun=d_earth_sun)
+
+    states = {"orbits": corrected_orbits, "epochs": corrected_t0, "H": H,
+              "tracklet_id": tracklet_id, "orbit_id": orbit_id, "n_culled": n_culled}
+    if not converged.all():
+        states = select_states(states, converged)
+
+    return states
+
+
+def select_states(states, mask):
+    """Select a subset of the orbits in a states dictionary (see `variant_orbit_states`)
+
+    Parameters
+    ----------
+    states : `dict`
+        Dictionary of variant orbit states
+    mask : `array`
+        Boolean mask or indices of the orbits to keep
+
+    Returns
+    -------
+    subset : `dict`
+        Dictionary of the same form containing only the selected orbits
+    """
+    return {key: (value[mask] if isinstance(value, np.ndarray) else value) for key, value in states.items()}
+
+
+def nearest_time_index(mjd, eph_mjd):
+    """Find which of a set of requested times each returned time corresponds to (allowing for the round-off
+    that comes with passing times through pyoorb)
+
+    Parameters
+    ----------
+    mjd : `array`
+        Returned times
+    eph_mjd : `array`
+        Requested times
+
+    Returns
+    -------
+    time_index : `array`
+        Index of the closest requested time to each returned time
+    """
+    mjd, eph_mjd = np.atleast_1d(mjd), np.atleast_1d(eph_mjd)
+    if len(eph_mjd) == 1:
+        return np.zeros(len(mjd), dtype=int)
+
+    order = np.argsort(eph_mjd, kind="stable")
+    sorted_mjd = eph_mjd[order]
+    right = np.clip(np.searchsorted(sorted_mjd, mjd), 1, len(sorted_mjd) - 1)
+    left_closer = np.abs(mjd - sorted_mjd[right - 1]) <= np.abs(sorted_mjd[right] - mjd)
+    return order[np.where(left_closer, right - 1, right)]
+
+
+def states_to_ephemerides(states, eph_times, obs_code="I11", location="Gemini South",
+                          ephemeris_backend="pyoorb", validate=False, observatory=None, num_jobs="auto",
+                          chunk_size=100):
+    """Get ephemerides for a set of variant orbit states, either with pyoorb (through THOR) or with the
+    vectorised two-body propagator in `twobody`
+
+    Parameters
+    ----------
+    states : `dict`
+        Dictionary of variant orbit states (see `variant_orbit_states`)
+    eph_times : `Astropy Time object/list`
+        Times at which to produce ephemerides. Either a single Time array that is used for every tracklet or
+        a list with a Time array for each tracklet.
+    obs_code : `str`, optional
+        Observatory code, by default "I11"
+    location : `str`, optional
+        Location of the observatory (only used by the two-body backend), by default "Gemini South"
+    ephemeris_backend : `str`, optional
+        Either "pyoorb" (full N-body) or "twobody" (analytic two-body, only suitable for short windows), by
+        default "pyoorb"
+    validate : `bool`, optional
+        If using the "twobody" backend, also run pyoorb and report the deviation from it (stored in
+        `df.attrs["validation"]`), by default False
+    observatory : `ObservatoryEphemeris`, optional
+        Precomputed observatory table to interpolate for the two-body backend's observer states, by default
+        None
+
+    Returns
+    -------
+    df : `pandas DataFrame`
+        Dataframe of ephemerides with a `tracklet_id` and `orbit_id` column identifying each variant orbit and
+        a `time_index` column giving the index of each row's time in `eph_times` (of its tracklet) so that it
+        can be matched to other tables without comparing floats, `df.attrs["n_culled"]` records how many grid
+        points were removed by the NEO cut
+    """
+    if ephemeris_backend not in ["pyoorb", "twobody"]:
+        raise ValueError(f"Invalid value for `ephemeris_backend`: {ephemeris_backend}")
+
+    # work out which group of times each orbit needs, tracklets with identical times are done together
+    if isinstance(eph_times, Time):
+        time_groups = [(eph_times, np.repeat(True, len(states["orbits"])))]
+    else:
+        groups = {}
+        for i, times in enumerate(eph_times):
+            groups.setdefault(np.atleast_1d(times.mjd).tobytes(), (times, []))[1].append(i)
+        time_groups = [(times, np.isin(states["tracklet_id"], ids)) for times, ids in groups.values()]
+
+    dfs, validation = [], []
+    for times, mask in time_groups:
+        if not mask.any():
+            continue
+        rows = np.arange(len(mask))[mask]
+        times = Time(np.atleast_1d(times))
+
+        if ephemeris_backend == "twobody":
+            if observatory is not None:
+                observer_states = observatory.states(times.utc.mjd)
+            else:
+                observer_states = observer_heliocentric_states(times, _observer_location(location))
+            df = generate_ephemeris(orbits=states["orbits"][rows], epochs=states["epochs"][rows],
+                                    eph_times=times.utc.mjd, observer_states=observer_states,
+                                    H=states["H"][rows] if states["H"] is not None else None,
+                                    ids=rows, obs_code=obs_code)
+
+        if ephemeris_backend == "pyoorb" or validate:
+            orbits_class = thor.Orbits(orbits=states["orbits"][rows],
+                                       epochs=Time(states["epochs"][rows], format="mjd"),
+                                       ids=rows.astype(str),
+                                       H=states["H"][rows] if states["H"] is not None else None)
+
+            # use pyoorb (through THOR) to get the emphemeris at the supplied times
+            pyoorb_df = backend.generateEphemeris(orbits=orbits_class, observers={obs_code: times},
+                                                  num_jobs=num_jobs, chunk_size=chunk_size)
+            pyoorb_df["time_index"] = nearest_time_index(pyoorb_df["mjd_utc"].values, times.utc.mjd)
+            if ephemeris_backend == "pyoorb":
+                df = pyoorb_df
+            else:
+                validation.append(compare_ephemerides(df, pyoorb_df))
+
+        # convert the row ids back into the tracklet and grid ids
+        rows = df["orbit_id"].astype(int).values
+        df["tracklet_id"] = states["tracklet_id"][rows]
+        df["orbit_id"] = states["orbit_id"][rows]
+        dfs.append(df)
+
+    if len(dfs) == 0:
+        df = pd.DataFrame(columns=["tracklet_id", "orbit_id", "mjd_utc", "time_index"])
+    else:
+        df = pd.concat(dfs).sort_values(["tracklet_id", "orbit_id", "mjd_utc"])
+        df.reset_index(drop=True, inplace=True)
+    df.attrs["n_culled"] = states.get("n_culled", 0)
+
+    # combine the comparisons for each group of times into the worst case
+    if validate and ephemeris_backend == "twobody" and len(validation) > 0:
+        df.attrs["validation"] = {key: (np.sum if key == "n_compared" else np.max)([v[key]
+                                                                                    for v in validation])
+                                  for key in validation[0]}
+        print("Two-body deviation from pyoorb:", df.attrs["validation"])
+    return df
+
+
+def variant_orbit_ephemerides_batch(ra, dec, ra_end, dec_end, delta_t, obstime, distances, radial_velocities,
+                                    sigma_ra=0.1 * u.arcsecond, sigma_dec=0.1 * u.arcsecond,
+                                    apparent_mag=None, eph_times=None, coords="heliocentriceclipticiau76",
+                                    location="Gemini South", obs_code="I11", pm_ra_cosdec=None, pm_dec=None,
+                                    only_neos=False, transform="astropy", light_time="thor",
+                                    ephemeris_backend="pyoorb", validate=False, observatory=None,
+                                    grid_points=None, rng=None, verbose=False, num_jobs="auto",
+                                    chunk_size=100):
+    """Generate ephemerides for a series of variant orbits for many tracklets at once. This is the batched
+    version of `variant_orbit_ephemerides`, each of `ra`, `dec`, `ra_end`, `dec_end`, `delta_t`, `obstime`
+    and `apparent_mag` may be an array with one entry per tracklet.
+
+    Parameters
+    ----------
+    eph_times : `Astropy Time object/list`, optional
+        Times at which to produce ephemerides. Either a single Time array shared by every tracklet or a list
+        with a Time array for each tracklet, by default 1 day after each observation
+
+    See `variant_orbit_ephemerides` for the remaining parameters.
+
+    Returns
+    -------
+    df : `pandas DataFrame`
+        Dataframe containing ephemerides for each tracklet and distance-radial velocity combination, keyed
+        by the `tracklet_id` and `orbit_id` columns
+    """
+    states = variant_orbit_states(ra=ra, dec=dec, ra_end=ra_end, dec_end=dec_end, delta_t=delta_t,
+                                  obstime=obstime, distances=distances, radial_velocities=radial_velocities,
+                                  sigma_ra=sigma_ra, sigma_dec=sigma_dec, apparent_mag=apparent_mag,
+                                  coords=coords, location=location, pm_ra_cosdec=pm_ra_cosdec, pm_dec=pm_dec,
+                                  only_neos=only_neos, transform=transform, light_time=light_time,
+                                  observatory=observatory, grid_points=grid_points, rng=rng,
+                                  verbose=verbose)
+
+    # default to one day after each observation
+    if eph_times is None:
+        eph_times = [np.atleast_1d(t + 1) for t in Time(np.atleast_1d(obstime))]
+
+    return states_to_ephemerides(states, eph_times=eph_times, obs_code=obs_code, location=location,
+                                 ephemeris_backend=ephemeris_backend, validate=validate,
+                                 observatory=observatory, num_jobs=num_jobs, chunk_size=chunk_size)
+
+
 def variant_orbit_ephemerides(ra, dec, ra_end, dec_end, delta_t, obstime, distances, radial_velocities,
                               sigma_ra=0.1 * u.arcsecond, sigma_dec=0.1 * u.arcsecond, apparent_mag=None,
                               eph_times=None, coords="heliocentriceclipticiau76", location="Gemini South",
-                              obs_code="I11", pm_ra_cosdec=None, pm_dec=None, only_neos=False, verbose=False,
+                              obs_code="I11", pm_ra_cosdec=None, pm_dec=None, only_neos=False,
+                              transform="astropy", light_time="thor", ephemeris_backend="pyoorb",
+                              validate=False, observatory=None, grid_points=None, rng=None, verbose=False,
                               num_jobs="auto", chunk_size=100):
     """Generate ephemerides for a series of variant orbits for an observed object without constraints on its
     distance and radial velocity.
@@ -84,6 +528,22 @@ def variant_orbit_ephemerides(ra, dec, ra_end, dec_end, delta_t, obstime, distan
         As `location` for the 3 character code, by default "I11"
     only_neos : `bool`, optional
         Whether to restrict orbits to only those that match an NEO (q < 1.3), by default False
+    transform : `str`, optional
+        Engine for the GCRS to ecliptic transform, either "astropy" or "numpy", by default "astropy"
+    light_time : `str`, optional
+        Light-time solver, either "thor" or "numpy" (vectorised, drops orbits that fail), by default "thor"
+    ephemeris_backend : `str`, optional
+        Either "pyoorb" or "twobody" (vectorised Kepler solver for short windows), by default "pyoorb"
+    validate : `bool`, optional
+        Whether to report the deviation of the "twobody" backend from pyoorb, by default False
+    observatory : `ObservatoryEphemeris`, optional
+        Precomputed observatory table (see `observatory.build_observatory_table`), by default None
+    grid_points : `array`, optional
+        Indices of a subset of the flattened grid of distances and radial velocities to use (e.g. from
+        `adaptive_grid_sample`), by default the whole grid
+    rng : `numpy Generator/SeedSequence/int`, optional
+        Seed (or generator) for the astrometric scatter (see `variant_orbit_states`), by default the global
+        `np.random`
     verbose: `bool`, optional
         Whether to print some debugging messages, by default False
 
@@ -94,111 +554,226 @@ def variant_orbit_ephemerides(ra, dec, ra_end, dec_end, delta_t, obstime, distan
 
     """
 
-    # create a grid from the distances and radial velocities
-    D, RV = np.meshgrid(distances, radial_velocities)
-    size = len(distances) * len(radial_velocities)
+    # default to one day after the observation
+    if eph_times is None:
+        eph_times = np.atleast_1d(obstime + 1)
 
-    # use astropy to get information based on a site name
-    if location == "Gemini South":
-        # avoid using the internet for hyak if it is just Gemini South
-        obs_loc = EarthLocation(1820193.06844603, -5208343.03427567, -3194842.50048343, unit="m")
-    else:
-        obs_loc = EarthLocation.of_site(location)
+    df = variant_orbit_ephemerides_batch(ra=ra, dec=dec, ra_end=ra_end, dec_end=dec_end, delta_t=delta_t,
+                                         obstime=obstime, distances=distances,
+                                         radial_velocities=radial_velocities, sigma_ra=sigma_ra,
+                                         sigma_dec=sigma_dec, apparent_mag=apparent_mag, eph_times=eph_times,
+                                         coords=coords, location=location, obs_code=obs_code,
+                                         pm_ra_cosdec=pm_ra_cosdec, pm_dec=pm_dec, only_neos=only_neos,
+                                         transform=transform, light_time=light_time,
+                                         ephemeris_backend=ephemeris_backend, validate=validate,
+                                         observatory=observatory, grid_points=grid_points, rng=rng,
+                                         verbose=verbose, num_jobs=num_jobs, chunk_size=chunk_size)
+    return df.drop(columns="tracklet_id")
+
+
+def variant_orbit_ephemerides_chunks(distances, radial_velocities, grid_points=None, orbits_per_chunk=100,
+                                     max_rows=None, **kwargs):
+    """Generate ephemerides for variant orbits in blocks of orbits so that memory use is bounded. Each chunk
+    goes through the whole of `variant_orbit_ephemerides` (grid, observer positions, transforms, light time
+    and ephemerides) for only its subset of the grid.
 
-    # need a list with units rather than list of things each with units
-    obsgeoloc = [x.to(u.m).value for x in obs_loc.geocentric] * u.m
+    Parameters
+    ----------
+    distances : `float/array`
+        Array of possible distances to use
+    radial_velocities : `float/array`
+        Array of possible radial velocities to use
+    grid_points : `array`, optional
+        Indices of the points in the flattened distance-radial velocity grid to use, by default all of them
+    orbits_per_chunk : `int`, optional
+        Number of variant orbits in each chunk, by default 100
+    max_rows : `int`, optional
+        Alternatively, the maximum number of ephemeris rows (orbits x times) in a chunk, by default None
+    **kwargs
+        Any other arguments for `variant_orbit_ephemerides`
+
+    Yields
+    ------
+    df : `pandas DataFrame`
+        Ephemerides for the next block of orbits
+    """
+    if grid_points is None:
+        grid_points = np.arange(len(distances) * len(radial_velocities))
+    grid_points = np.atleast_1d(grid_points)
 
-    # get the observer position in cartesian GCRS coordinates for THOR
-    observer_position = SkyCoord(x=obsgeoloc[0],
-                                 y=obsgeoloc[1],
-                                 z=obsgeoloc[2],
-                                 obstime=obstime,
-                                 frame="gcrs",
-                                 representation_type="cartesian").transform_to(coords).cartesian.xyz
-    observer_positions = np.tile(observer_position.to(u.AU).value, (size, 1))
+    # use the same seed in every chunk, each orbit's scatter is picked out of that of the full grid
+    if kwargs.get("rng") is not None:
+        kwargs["rng"] = scatter_seed(kwargs["rng"])
 
-    # if proper motions are not provided
-    if pm_ra_cosdec is None and pm_dec is None:
-        # add some dispersion to the ra/dec's with the given sigmas (or just repeat if not are given)
-        if sigma_ra.value == 0.0:
-            ra = np.repeat(ra.value, repeats=size) * ra.unit
-            ra_end = np.repeat(ra_end.value, repeats=size) * ra_end.unit
-        else:
-            # TODO: check with Mario about adding scatter near poles
-            ra = np.random.normal(ra.value, scale=sigma_ra.to(ra.unit).value, size=size) * ra.unit
-            ra_end = np.random.normal(ra_end.value, scale=sigma_ra.to(ra_end.unit).value, size=size) * ra_end.unit
+    if max_rows is not None:
+        eph_times = kwargs.get("eph_times")
+        n_times = 1 if eph_times is None else len(np.atleast_1d(eph_times))
+        orbits_per_chunk = max(max_rows // n_times, 1)
 
-        if sigma_dec.value == 0.0:
-            dec = np.repeat(dec.value, repeats=size) * dec.unit
-            dec_end = np.repeat(dec_end.value, repeats=size) * dec_end.unit
-        else:
-            dec = np.random.normal(dec.value, scale=sigma_dec.to(dec.unit).value, size=size) * dec.unit
-            dec_end = np.random.normal(dec_end.value, scale=sigma_dec.to(dec_end.unit).value, size=size) * dec_end.unit
+    for start in range(0, len(grid_points), orbits_per_chunk):
+        yield variant_orbit_ephemerides(distances=distances, radial_velocities=radial_velocities,
+                                        grid_points=grid_points[start:start + orbits_per_chunk], **kwargs)
 
-        # convert them to Skycoords
-        start = SkyCoord(ra=ra, dec=dec, frame="icrs")
-        end = SkyCoord(ra=ra_end, dec=dec_end, frame="icrs")
 
-        # calculate the offset in ra/dec and convert to a proper motion
-        delta_ra_cosdec, delta_dec = start.spherical_offsets_to(end)
-        pm_ra_cosdec, pm_dec = delta_ra_cosdec / delta_t, delta_dec / delta_t
+def adaptive_grid_sample(n_distances, n_radial_velocities, evaluate, coarse_step=5):
+    """Sample a distance-radial velocity grid coarse-to-fine. A coarse grid is evaluated first, then each
+    cell has its centre evaluated and is split in four whenever its corners and centre disagree, until the
+    cells reach the resolution of the full grid. Cells that agree are filled in with the shared value.
 
-        if verbose:
-            print(ra, dec, ra_end, dec_end, delta_t, pm_ra_cosdec, pm_dec)
+    Parameters
+    ----------
+    n_distances : `int`
+        Number of distances in the full grid
+    n_radial_velocities : `int`
+        Number of radial velocities in the full grid
+    evaluate : `function`
+        Function that takes an array of indices into the flattened grid (as `orbit_id` in
+        `variant_orbit_states`) and returns an integer state for each (e.g. 0/1 for not findable/findable)
+    coarse_step : `int`, optional
+        Spacing of the initial coarse grid in grid points, by default 5
 
-    # put it all together into a single astropy SkyCoord in GCRS (using loc/time from above)
-    coord = SkyCoord(ra=ra,
-                     dec=dec,
-                     pm_ra_cosdec=pm_ra_cosdec,
-                     pm_dec=pm_dec,
-                     distance=D.ravel(),
-                     radial_velocity=RV.ravel(),
-                     frame="gcrs",
-                     obsgeoloc=obsgeoloc,
-                     obstime=obstime)
-
-    # convert to ecliptic
-    ecl = coord.transform_to(coords)
-
-    # translate astropy into what THOR wants
-    orbits = np.atleast_2d(np.concatenate((ecl.cartesian.xyz.to(u.AU).value,
-                                           ecl.velocity.d_xyz.to(u.AU / u.day).value))).T
-    t0 = np.repeat(ecl.obstime.mjd, size)
-
-    # use THOR to account for light travel time
-    corrected_orbits, lt = thor.addLightTime(orbits=orbits, t0=t0, observer_positions=observer_positions,
-                                             lt_tol=1e-10, mu=Constants.MU, max_iter=1000, tol=1e-15)
-    lt = np.nan_to_num(lt, nan=0.0)
-    corrected_t0 = t0 - lt
+    Returns
+    -------
+    states : `array`
+        State of every point in the flattened grid (evaluated or filled in)
+    evaluated : `array`
+        Boolean mask of which points were actually evaluated
+    mismatch_rate : `float`
+        Estimated fraction of filled in points that have the wrong state, from how often a cell centre
+        disagreed with corners that all agreed (with a rule of succession so it is never zero)
+    """
+    states = np.full((n_radial_velocities, n_distances), -1)
+    evaluated = np.zeros_like(states, dtype=bool)
+
+    def evaluate_points(rv_inds, d_inds):
+        inds = (np.asarray(rv_inds, dtype=int), np.asarray(d_inds, dtype=int))
+        points = np.unique(np.ravel_multi_index(inds, states.shape))
+        points = points[~evaluated.ravel()[points]]
+        if len(points) > 0:
+            states.ravel()[points] = evaluate(points)
+            evaluated.ravel()[points] = True
+
+    def pairs(inds):
+        return list(zip(inds[:-1], inds[1:])) if len(inds) > 1 else [(inds[0], inds[0])]
+
+    def cell_grid(rv_inds, d_inds):
+        RV, D = np.meshgrid(rv_inds, d_inds, indexing="ij")
+        cells = [(r0, r1, d0, d1) for r0, r1 in pairs(rv_inds) for d0, d1 in pairs(d_inds)]
+        return RV.ravel(), D.ravel(), cells
+
+    # start with the coarse grid (always including the edges)
+    rv_coarse = np.unique(np.append(np.arange(0, n_radial_velocities, coarse_step), n_radial_velocities - 1))
+    d_coarse = np.unique(np.append(np.arange(0, n_distances, coarse_step), n_distances - 1))
+    rv_inds, d_inds, cells = cell_grid(rv_coarse, d_coarse)
+    evaluate_points(rv_inds, d_inds)
+
+    n_checked, n_mismatched = 0, 0
+    while len(cells) > 0:
+        # evaluate the centre of every cell that still has points inside it
+        cells = [cell for cell in cells if cell[1] - cell[0] > 1 or cell[3] - cell[2] > 1]
+        agree = [(states[np.ix_(cell[:2], cell[2:])] == states[cell[0], cell[2]]).all() for cell in cells]
+        evaluate_points([(r0 + r1) // 2 for r0, r1, _, _ in cells],
+                        [(d0 + d1) // 2 for _, _, d0, d1 in cells])
+
+        new_rv, new_d, new_cells = [], [], []
+        for (r0, r1, d0, d1), corners_agree in zip(cells, agree):
+            corner, centre = states[r0, d0], states[(r0 + r1) // 2, (d0 + d1) // 2]
+            if corners_agree:
+                n_checked += 1
+                n_mismatched += centre != corner
+
+            # fill in cells that agree and split the rest into four
+            if corners_agree and centre == corner:
+                block = states[r0:r1 + 1, d0:d1 + 1]
+                block[block == -1] = corner
+            else:
+                rv_inds, d_inds, sub_cells = cell_grid(np.unique([r0, (r0 + r1) // 2, r1]),
+                                                       np.unique([d0, (d0 + d1) // 2, d1]))
+                new_rv.append(rv_inds)
+                new_d.append(d_inds)
+                new_cells += sub_cells
+
+        if len(new_cells) > 0:
+            evaluate_points(np.concatenate(new_rv), np.concatenate(new_d))
+        cells = new_cells
+
+    mismatch_rate = (n_mismatched + 1) / (n_checked + 2)
+    return states.ravel(), evaluated.ravel(), mismatch_rate
+
+
+def wilson_interval(k, n, z=1.96):
+    """Wilson score interval for a binomial proportion
 
-    if apparent_mag is None:
-        H = None
-    else:
-        d_ast_sun = ecl.distance.to(u.AU).value
-        d_ast_earth = D.ravel().to(u.AU).value
-        d_earth_sun = get_sun(time=Time(corrected_t0, format="mjd")).distance.to(u.AU).value
-        H = absolute_magnitude(m=apparent_mag,
-                               d_ast_sun=d_ast_sun, d_ast_earth=d_ast_earth, d_earth_sun=d_earth_sun)
+    Parameters
+    ----------
+    k : `int`
+        Number of successes
+    n : `int`
+        Number of trials
+    z : `float`, optional
+        Number of standard deviations for the interval, by default 1.96 (95%)
 
-    # create a THOR orbits class
-    orbits_class = thor.Orbits(orbits=corrected_orbits, epochs=Time(corrected_t0, format="mjd"), H=H)
+    Returns
+    -------
+    lower, upper : `float`
+        Bounds of the interval
+    """
+    if n == 0:
+        return 0.0, 1.0
+    p = k / n
+    centre = (p + z**2 / (2 * n)) / (1 + z**2 / n)
+    half_width = z * np.sqrt(p * (1 - p) / n + z**2 / (4 * n**2)) / (1 + z**2 / n)
+    return max(centre - half_width, 0.0), min(centre + half_width, 1.0)
 
-    # if you only want NEO orbits then mask anything with a perihelion above 1.3 AU
-    if only_neos:
-        perihelion = orbits_class.keplerian[:, 0] * (1 - orbits_class.keplerian[:, 1])
-        orbits_class = thor.Orbits(orbits=corrected_orbits[perihelion < 1.3],
-                                   epochs=Time(corrected_t0[perihelion < 1.3], format="mjd"),
-                                   H=H[perihelion < 1.3] if H is not None else H)
 
-    # default to one day after the observation
-    if eph_times is None:
-        eph_times = np.atleast_1d(obstime + 1)
+def sequential_grid_sample(n_points, evaluate, batch_size=50, tolerance=0.05, z=1.96, rng=None):
+    """Evaluate a grid of variant orbits in randomised batches until the fraction of them with state 1 is
+    known well enough. After each batch a Wilson interval is computed on the fraction (ignoring points with
+    state 2, e.g. culled non-NEOs) and sampling stops once its half-width is below `tolerance`.
 
-    # use pyoorb (through THOR) to get the emphemeris at the supplied times
-    df = backend.generateEphemeris(orbits=orbits_class, observers = {obs_code: eph_times},
-                                   num_jobs=num_jobs, chunk_size=chunk_size)
+    Parameters
+    ----------
+    n_points : `int`
+        Number of points in the flattened grid
+    evaluate : `function`
+        Function that takes an array of indices into the flattened grid and returns an integer state for
+        each (0/1 for not findable/findable, 2 to ignore)
+    batch_size : `int`, optional
+        Number of points to evaluate in each batch, by default 50
+    tolerance : `float`, optional
+        Target half-width of the interval, by default 0.05
+    z : `float`, optional
+        Number of standard deviations for the interval, by default 1.96 (95%)
+    rng : `numpy Generator/SeedSequence/int`, optional
+        Random number generator (or seed) for the order of the points, by default the global `np.random`
 
-    return df
+    Returns
+    -------
+    states : `array`
+        State of every point in the flattened grid (-1 for points that were not evaluated)
+    interval : `tuple`
+        Lower and upper bounds on the fraction (equal to the fraction if every point was evaluated)
+    """
+    states = np.full(n_points, -1)
+    rng = np.random if rng is None else np.random.default_rng(rng)
+    order = rng.permutation(n_points)
+
+    # nothing known yet (which is also the answer for an empty grid)
+    k, n = 0, 0
+    lower, upper = wilson_interval(k, n, z=z)
+    for start in range(0, n_points, batch_size):
+        batch = order[start:start + batch_size]
+        states[batch] = evaluate(batch)
+
+        k, n = (states == 1).sum(), np.isin(states, [0, 1]).sum()
+        lower, upper = wilson_interval(k, n, z=z)
+        if n > 0 and (upper - lower) / 2 < tolerance:
+            break
+
+    # no uncertainty left if everything got evaluated
+    if (states != -1).all():
+        lower = upper = k / n if n > 0 else 0.0
+    return states, (lower, upper)
 
 
 def create_scout_comparison_plot(day, time, des="P21vBEn", distances=None, radial_velocities=None,